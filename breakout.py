@@ -1,5 +1,19 @@
+import gc
 import os
 import json
+import time
+import zlib
+import struct
+import copy
+import ctypes
+import random
+import socket
+import argparse
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from time import perf_counter
 from math import copysign, floor, ceil
 
 import pygame
@@ -7,8 +21,21 @@ from pygame import Rect, Color
 from pygame.math import Vector2
 from pygame.surface import Surface
 
+from glyphs import GlyphAtlas, TextLabel
+from resources import resources
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 os.environ['SDL_VIDEO_CENTERED'] = '1'
 
+# Images preloaded at startup, with their color key
+image_assets = [("tiles_dual_16_8_forest.png", (0, 0, 0))]
+# Fonts preloaded at startup, with their size
+font_assets = [("freesansbold.ttf", 10)]
+
 
 ###############################################################################
 #                                 Engine                                      #
@@ -42,15 +69,30 @@ class Grid:
         self.cell_width: int = cell_width
         self.cell_height: int = cell_height
         self._dirty = False
+        self._cells_shared = False
+        # Incremented on every cell change, used by rendering caches
+        self.revision = 0
 
     def set_dirty(self):
         self._dirty = True
+        self.revision += 1
 
     def fill(self, value):
         pass
 
     def fill_with_data(self, data):
         self.cells = data
+        self._cells_shared = False
+
+    # Copy-on-write: a shared cell list is copied by the first grid that modifies it
+    def share_cells(self) -> list[Cell]:
+        self._cells_shared = True
+        return self.cells
+
+    def _own_cells(self):
+        if self._cells_shared:
+            self.cells = [copy.copy(c) for c in self.cells]
+            self._cells_shared = False
 
     @property
     def height(self):
@@ -65,6 +107,9 @@ class Grid:
         y = (world_y - self.y) // self.cell_height
         return x, y
 
+    def get_cell_rect(self, x, y) -> Rect:
+        return Rect(self.x + x * self.cell_width, self.y + y * self.cell_height, self.cell_width, self.cell_height)
+
     def get_cell(self, x, y) -> Cell:
         if x >= self.width or x < 0:
             return Grid.error_cell
@@ -79,9 +124,68 @@ class Grid:
         if y < 0 or y >= self.height: return
         index = x + y * self.width
         if 0 <= index < len(self.cells):
+            self._own_cells()
             self.cells[index].alive = False
             self.set_dirty()
 
+    def kill_cells(self, cells) -> int:
+        # Bulk version of kill_cell, the grid is marked dirty once. Returns the number of bricks destroyed
+        killed = False
+        count = 0
+        for x, y in cells:
+            if 0 <= x < self.width and 0 <= y < self.height:
+                if not killed:
+                    self._own_cells()
+                    killed = True
+                cell = self.cells[x + y * self.width]
+                count += cell.alive
+                cell.alive = False
+        if killed:
+            self.set_dirty()
+        return count
+
+    def set_cells_alive(self, values: list[int]) -> int:
+        # Only writes the cells whose state differs, the grid is marked dirty once. Returns the number changed
+        changed = [i for i, (c, v) in enumerate(zip(self.cells, values)) if c.alive != bool(v)]
+        if changed:
+            self._own_cells()
+            for i in changed:
+                self.cells[i].alive = bool(values[i])
+            self.set_dirty()
+        return len(changed)
+
+    def revive_cell(self, x: int, y: int):
+        if x < 0 or x >= self.width: return
+        if y < 0 or y >= self.height: return
+        self._own_cells()
+        self.cells[x + y * self.width].alive = True
+        self.set_dirty()
+
+    def get_bounds(self) -> tuple[int, int, int, int]:
+        return self.x, self.y, self.width, self.height
+
+    def expand(self, x: int, y: int, width: int, height: int):
+        # Grow the grid with dead cells until it covers the given bounds
+        left = min(self.x, x)
+        top = min(self.y, y)
+        right = max(self.x + self.width * self.cell_width, x + width * self.cell_width)
+        bottom = max(self.y + self.height * self.cell_height, y + height * self.cell_height)
+        new_width = (right - left) // self.cell_width
+        new_height = (bottom - top) // self.cell_height
+        if (left, top, new_width, new_height) == self.get_bounds():
+            return
+
+        self._own_cells()
+        cells: list[Cell] = [Cell(False) for _ in range(new_width * new_height)]
+        offset_x = (self.x - left) // self.cell_width
+        offset_y = (self.y - top) // self.cell_height
+        for index, c in enumerate(self.cells):
+            cells[offset_x + index % self.width + (offset_y + index // self.width) * new_width] = c
+        self.x = left
+        self.y = top
+        self.width = new_width
+        self.cells = cells
+
     def kill_cell_world(self, pos: Vector2):
         x = int(pos.x) - self.x
         y = int(pos.y) - self.y
@@ -113,6 +217,27 @@ class Grid:
         return [c for c in self.cells[column::self.width] if not c.alive]
 
 
+class GridIndex:
+    # Uniform bucket index of grid rectangles for point picking
+    def __init__(self, bucket_width: int = 32, bucket_height: int = 32):
+        self.bucket_width = bucket_width
+        self.bucket_height = bucket_height
+        self.buckets: dict[tuple[int, int], list[Grid]] = {}
+
+    def build(self, grids: list[Grid]):
+        self.buckets.clear()
+        for g in grids:
+            rect = g.get_rect()
+            if rect.w == 0 or rect.h == 0:
+                continue
+            for bx in range(rect.left // self.bucket_width, (rect.right - 1) // self.bucket_width + 1):
+                for by in range(rect.top // self.bucket_height, (rect.bottom - 1) // self.bucket_height + 1):
+                    self.buckets.setdefault((bx, by), []).append(g)
+
+    def query_point(self, x: float, y: float) -> list[Grid]:
+        return self.buckets.get((int(x // self.bucket_width), int(y // self.bucket_height)), [])
+
+
 ###############################################################################
 #                               Game State                                    #
 ###############################################################################
@@ -123,6 +248,12 @@ class BrickGrid(Grid):
         super().__init__(x, y, width, cell_width, cell_height)
         self.environment = environment
 
+    @classmethod
+    def from_level_data(cls, data: dict, cell_width: int, cell_height: int):
+        grid = cls(data["x"], data["y"], data["width"], cell_width, cell_height, data["env"])
+        grid.cells = [Brick() for _ in data["cells"]]
+        return grid
+
     def collide_point(self, point: Vector2) -> bool:
         return self.is_cell_alive_world(point)
 
@@ -130,7 +261,7 @@ class BrickGrid(Grid):
         if not self._dirty:
             return
 
-        pygame.image.save(pygame.display.get_surface(), "breakute.png")
+        self._own_cells()
 
         # Trim Grid from Top
         cells_to_delete = []
@@ -153,28 +284,36 @@ class BrickGrid(Grid):
         for c in cells_to_delete:
             self.cells.remove(c)
 
+        if not self.cells:
+            self._dirty = False
+            return
+
         # Trim Grid from Left
         cells_to_delete = []
+        column_count = 0
         for i in range(self.width):
             col = self.get_column(i)
             if len(col) < self.height:
                 break
             cells_to_delete.extend(col)
+            column_count += 1
             self.x += self.cell_width
-            self.width -= 1
         for c in cells_to_delete:
             self.cells.remove(c)
+        self.width -= column_count
 
         # Trim Grid from Right
         cells_to_delete = []
+        column_count = 0
         for i in reversed(range(self.width)):
             col = self.get_column(i)
             if len(col) < self.height:
                 break
             cells_to_delete.extend(col)
-            self.width -= 1
+            column_count += 1
         for c in cells_to_delete:
             self.cells.remove(c)
+        self.width -= column_count
 
         self._dirty = False
 
@@ -198,54 +337,166 @@ class GameStateObserver:
     def on_brick_grid_destroyed(self, brick_grid: BrickGrid):
         pass
 
+    def on_bricks_destroyed(self, brick_grid: BrickGrid, cells):
+        pass
+
+    def on_state_restored(self):
+        pass
+
+    def on_level_reloaded(self):
+        pass
+
+    def on_level_unloaded(self):
+        pass
+
+    def on_level_loaded(self):
+        pass
+
+
+class Player:
+    def __init__(self, index: int, paddle, input_source=None):
+        self.index = index
+        self.paddle: Paddle = paddle
+        # Source of the frame inputs of every player but the first, which is fed by the game mode
+        self.input_source: InputSource = input_source
+
 
 class GameState:
+    starting_lives = 3
+
     def __init__(self):
         self.level_index = 0
+        self.score = 0
+        self.lives = self.starting_lives
         self.area = Rect(0, 0, 160, 240)
         self.paddle: Paddle = Paddle(Vector2(0, 200))
         self.paddle.rect.centerx = self.area.centerx
-        self.balls: list[Ball] = []
+        self.players: list[Player] = [Player(0, self.paddle)]
+        self.paddles: list[Paddle] = [self.paddle]
+        self.effect_config: EffectConfig = EffectConfig.load()
+        self.entities = EntityStore(self.effect_config.budgets)
+        self.balls: list[Ball] = self.entities.balls
+        self.powerups: list[PowerUp] = self.entities.powerups
+        self.lasers: list[Laser] = self.entities.lasers
+        self.active_effects: list[ActiveEffect] = []
+        self.ball_speed_scale = 1.0
+        self.bricks_until_drop = self.effect_config.drop_interval
+        self.drop_count = 0
         self.brick_grids: list[BrickGrid] = []
+        self.brick_grids_revision = 0
+        self.level_pack: LevelPack = None
         self.collisions: list[Collision] = []
-        self.powerups: list[PowerUp] = []
         self.brick_width = 16
         self.brick_height = 8
         self.observers: list[GameStateObserver] = []
         self._is_level_dirty = False
+        self.verbose = True
 
     def add_observer(self, observer: GameStateObserver):
         self.observers.append(observer)
 
+    def log(self, message: str):
+        if self.verbose:
+            print(message)
+
+    def add_player(self, input_source=None) -> Player:
+        paddle = Paddle(Vector2(0, self.paddle.rect.y))
+        player = Player(len(self.players), paddle, input_source)
+        self.players.append(player)
+        self.paddles.append(paddle)
+
+        # Spread the paddles evenly across the area
+        for p in self.players:
+            p.paddle.rect.centerx = self.area.left + self.area.width * (2 * p.index + 1) // (2 * len(self.players))
+        return player
+
+    def get_player_balls(self, player: Player) -> list:
+        return [b for b in self.balls if b.owner is player]
+
+    def reset_score(self):
+        self.score = 0
+        self.lives = self.starting_lives
+
+    def activate_effect(self, name: str, player: Player):
+        effect = self.effect_config.effects[name]
+        # Collecting an effect that is still running only extends it
+        for active in self.active_effects:
+            if active.name == name and (active.player is player or not effect.per_player):
+                active.frames_left = effect.duration
+                return
+        effect.activate(self, player)
+        if effect.duration:
+            self.active_effects.append(ActiveEffect(name, player, effect.duration))
+
+    def clear_effects(self):
+        for active in self.active_effects:
+            self.effect_config.effects[active.name].deactivate(self, active.player)
+        self.active_effects.clear()
+        self.powerups.clear()
+        self.lasers.clear()
+
+    def invalidate_brick_grids(self):
+        # Called whenever grids are added, removed or change bounds
+        self.brick_grids_revision += 1
+
     def notify_ball_created(self, ball):
-        print("Ball Created")
+        self.log("Ball Created")
         for observer in self.observers:
             observer.on_ball_created(ball)
 
     def notify_ball_lost(self, ball):
-        print("Ball Lost")
+        self.log("Ball Lost")
         for observer in self.observers:
             observer.on_ball_lost(ball)
 
     def notify_balls_cleared(self):
-        print("All Balls Destroyed")
+        self.log("All Balls Destroyed")
         for observer in self.observers:
             observer.on_balls_cleared()
 
     def notify_last_ball_lost(self):
+        self.log("Last Ball Lost")
         for observer in self.observers:
             observer.on_last_ball_lost()
 
     def notify_last_brick_destroyed(self):
-        print("Last Brick Destroyed")
+        self.log("Last Brick Destroyed")
         for observer in self.observers:
             observer.on_last_brick_destroyed()
 
     def notify_brick_grid_destroyed(self, brick_grid: BrickGrid):
-        print("Brick Grid Destroyed")
+        self.log("Brick Grid Destroyed")
         for observer in self.observers:
             observer.on_brick_grid_destroyed(brick_grid)
 
+    def notify_bricks_destroyed(self, brick_grid: BrickGrid, cells):
+        for observer in self.observers:
+            observer.on_bricks_destroyed(brick_grid, cells)
+
+    def notify_state_restored(self):
+        self.log("State Restored")
+        for observer in self.observers:
+            observer.on_state_restored()
+
+    def notify_level_reloaded(self):
+        for observer in self.observers:
+            observer.on_level_reloaded()
+
+    def notify_level_unloaded(self):
+        for observer in self.observers:
+            observer.on_level_unloaded()
+
+    def notify_level_loaded(self):
+        for observer in self.observers:
+            observer.on_level_loaded()
+
+    def snapshot(self):
+        return GameStateSnapshot(self)
+
+    def restore(self, snapshot):
+        snapshot.restore(self)
+        self.notify_state_restored()
+
 
 class Entity:
     def __init__(self, position):
@@ -264,42 +515,160 @@ class Ball(Entity):
         super().__init__(position)
         self.rect = Rect(position.x, position.y, 4, 4)
         self.is_stuck_on_paddle = False
+        self.owner: Player = None
 
 
 class Paddle(Entity):
     speed = 2
+    width = 40
 
     def __init__(self, position: Vector2):
         super().__init__(position)
-        self.rect = Rect(position.x, position.y, 40, 4)
+        self.rect = Rect(position.x, position.y, Paddle.width, 4)
+
+
+class Laser(Entity):
+    def __init__(self, position: Vector2, speed: float):
+        super().__init__(position)
+        self.rect = Rect(position.x, position.y, 1, 4)
+        self.velocity = Vector2(0, -speed)
+
+
+class EntityStore:
+    # Dynamic entities of the game, spawning past the budget of a kind is refused
+    def __init__(self, budgets: dict[str, int]):
+        self.budgets = budgets
+        self.balls: list[Ball] = []
+        self.powerups: list[PowerUp] = []
+        self.lasers: list[Laser] = []
+
+    def room(self, kind: str) -> int:
+        return max(self.budgets.get(kind, 0) - len(getattr(self, kind)), 0)
+
+    def spawn(self, kind: str, entity: Entity) -> bool:
+        if not self.room(kind):
+            return False
+        getattr(self, kind).append(entity)
+        return True
 
 
 class Effect:
+    # Parameters come from effects.json, effects with a duration stay active that many frames
+    per_player = True
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.duration: int = config.get("duration", 0)
+
+    def activate(self, game_state: GameState, player: Player):
+        pass
+
+    def update(self, game_state: GameState, player: Player, active):
+        pass
+
+    def deactivate(self, game_state: GameState, player: Player):
+        pass
+
+
+class MultiBallEffect(Effect):
+    def activate(self, game_state: GameState, player: Player):
+        spread = self.config["spread"]
+        angles = [spread * (i // 2 + 1) * (1 if i % 2 else -1) for i in range(self.config["balls_per_ball"])]
+        # Balls past the budget are refused, the balls already in play keep their own clones first
+        for i in range(len(game_state.balls)):
+            b = game_state.balls[i]
+            if b.is_stuck_on_paddle:
+                continue
+            for angle in angles:
+                new_ball = Ball(Vector2(b.rect.x, b.rect.y))
+                new_ball.velocity = b.velocity.rotate(angle)
+                new_ball.owner = b.owner
+                if not game_state.entities.spawn("balls", new_ball):
+                    return
+                game_state.notify_ball_created(new_ball)
+
+
+class ExpandPaddleEffect(Effect):
+    def activate(self, game_state: GameState, player: Player):
+        self.resize(player.paddle, min(round(Paddle.width * self.config["scale"]), self.config["max_width"]))
+
+    def deactivate(self, game_state: GameState, player: Player):
+        self.resize(player.paddle, Paddle.width)
+
+    @staticmethod
+    def resize(paddle: Paddle, width: int):
+        center = paddle.rect.centerx
+        paddle.rect.width = width
+        paddle.rect.centerx = center
+
+
+class SlowBallEffect(Effect):
+    # Shared by every player, collecting it again only extends it
+    per_player = False
+
+    def activate(self, game_state: GameState, player: Player):
+        game_state.ball_speed_scale = self.config["speed_scale"]
+
+    def deactivate(self, game_state: GameState, player: Player):
+        game_state.ball_speed_scale = 1.0
+
 
-    def activate(self, game_state: GameState):
-        for b in game_state.balls[:]:
-            pos = b.rect
-            velocity = b.velocity
+class LaserEffect(Effect):
+    def update(self, game_state: GameState, player: Player, active):
+        if (self.duration - active.frames_left) % self.config["interval"]:
+            return
+        rect = player.paddle.rect
+        for x in (rect.left + 2, rect.right - 3):
+            game_state.entities.spawn("lasers", Laser(Vector2(x, rect.top - 4), self.config["speed"]))
+
+
+# Effects that power-ups can carry, by name in effects.json
+effect_types = {"multiball": MultiBallEffect, "expand_paddle": ExpandPaddleEffect, "slow_ball": SlowBallEffect,
+                "laser": LaserEffect}
+
+
+class ActiveEffect:
+    def __init__(self, name: str, player: Player, frames_left: int):
+        self.name = name
+        self.player = player
+        self.frames_left = frames_left
+
+
+class EffectConfig:
+    # Parsed once per file, every game state of a process shares it
+    loaded: dict[str, "EffectConfig"] = {}
 
-            new_ball = Ball(Vector2(pos.x, pos.y))
-            new_ball.velocity = velocity.rotate(-10)
-            game_state.balls.append(new_ball)
-            game_state.notify_ball_created(new_ball)
+    def __init__(self, data: dict):
+        self.drop_interval: int = data["drop_interval"]
+        self.budgets: dict[str, int] = data["budgets"]
+        self.effects: dict[str, Effect] = {name: effect_types[name](config)
+                                           for name, config in data["effects"].items()}
 
-            new_ball = Ball(Vector2(pos.x, pos.y))
-            new_ball.velocity = velocity.rotate(10)
-            game_state.balls.append(new_ball)
-            game_state.notify_ball_created(new_ball)
+        # Power-ups cycle through this table, each effect appears as many times as its weight, interleaved
+        weights = {name: config.get("weight", 1) for name, config in data["effects"].items()}
+        self.drop_table: list[str] = []
+        while any(weights.values()):
+            for name in weights:
+                if weights[name]:
+                    self.drop_table.append(name)
+                    weights[name] -= 1
+
+    @classmethod
+    def load(cls, path: str = "effects.json"):
+        if path not in cls.loaded:
+            with open(path, mode="r", encoding="utf-8") as file:
+                cls.loaded[path] = cls(json.load(file))
+        return cls.loaded[path]
 
 
 class PowerUp(Entity):
     move_speed = 1
 
-    def __init__(self, position: Vector2):
+    def __init__(self, position: Vector2, effect: str = "multiball"):
         super().__init__(position)
         self.rect = Rect(position.x, position.y, 10, 6)
         self.velocity = Vector2(0, PowerUp.move_speed)
-        self.effect: Effect = Effect()
+        self.effect = effect
 
 
 class Collision:
@@ -319,17 +688,26 @@ class GridCollision(Collision):
         self.hit_cells = hit_cells
 
     def process(self):
-        for c in self.hit_cells:
-            brick: Brick = c[2]
-            self.brick_grid.kill_cell(c[0], c[1])
-
-        # Create PowerUp
-        if len(self.state.balls) == 1 and not self.state.powerups:
-            self.state.powerups.append(
-                PowerUp(Vector2(self.brick_grid.get_rect().centerx, self.brick_grid.get_rect().bottom)))
-
-        self.brick_grid.set_dirty()
-        self.state._is_level_dirty = True
+        GridCollision.kill_cells(self.state, self.brick_grid, {(c[0], c[1]) for c in self.hit_cells})
+
+    @staticmethod
+    def kill_cells(state: GameState, brick_grid: BrickGrid, cells: set[tuple[int, int]]):
+        # BrickGrid.kill_cells marks the grid dirty itself
+        count = brick_grid.kill_cells(cells)
+        if count:
+            state._is_level_dirty = True
+            state.score += count
+            state.notify_bricks_destroyed(brick_grid, cells)
+
+            # Create PowerUp every few bricks, as long as the store has room for one
+            state.bricks_until_drop -= count
+            if state.bricks_until_drop <= 0:
+                state.bricks_until_drop = state.effect_config.drop_interval
+                rect = brick_grid.get_cell_rect(*min(cells))
+                table = state.effect_config.drop_table
+                if state.entities.spawn("powerups", PowerUp(Vector2(rect.centerx, rect.bottom),
+                                                            table[state.drop_count % len(table)])):
+                    state.drop_count += 1
 
 
 class BallCollision(Collision):
@@ -367,6 +745,375 @@ class BallCollisionWithPaddle(Collision):
             self.collider.velocity.reflect_ip(self.axis)
 
 
+class GridSnapshot:
+    def __init__(self, grid: BrickGrid):
+        self.x = grid.x
+        self.y = grid.y
+        self.width = grid.width
+        self.cell_width = grid.cell_width
+        self.cell_height = grid.cell_height
+        self.environment = grid.environment
+        self.cells = grid.share_cells()
+
+    def restore(self) -> BrickGrid:
+        grid = BrickGrid(self.x, self.y, self.width, self.cell_width, self.cell_height, self.environment)
+        grid.cells = self.cells
+        grid.share_cells()
+        return grid
+
+    def as_dict(self) -> dict:
+        return {"x": self.x, "y": self.y, "width": self.width, "env": self.environment,
+                "cells": [int(c) for c in self.cells]}
+
+
+class EntitySnapshot:
+    def __init__(self, entity: Entity):
+        self.rect = tuple(entity.rect)
+        self.velocity = tuple(entity.velocity)
+        self.movement_remainder = tuple(entity.movement_remainder)
+        self.is_stuck_on_paddle = getattr(entity, "is_stuck_on_paddle", False)
+        owner = getattr(entity, "owner", None)
+        self.owner_index = owner.index if owner is not None else 0
+        self.effect = getattr(entity, "effect", None)
+
+    def restore_into(self, entity: Entity, state: GameState = None):
+        entity.rect.update(self.rect)
+        entity.velocity.update(self.velocity)
+        entity.movement_remainder.update(self.movement_remainder)
+        if isinstance(entity, Ball):
+            entity.is_stuck_on_paddle = self.is_stuck_on_paddle
+            entity.owner = state.players[self.owner_index]
+        if isinstance(entity, PowerUp):
+            entity.effect = self.effect
+        return entity
+
+    def as_dict(self) -> dict:
+        return {"rect": list(self.rect), "velocity": list(self.velocity),
+                "remainder": list(self.movement_remainder), "stuck": self.is_stuck_on_paddle,
+                "owner": self.owner_index, "effect": self.effect}
+
+    @staticmethod
+    def load_into(entity: Entity, data: dict, state: GameState = None):
+        entity.rect.update(data["rect"])
+        entity.velocity.update(data["velocity"])
+        entity.movement_remainder.update(data["remainder"])
+        if isinstance(entity, Ball):
+            entity.is_stuck_on_paddle = data["stuck"]
+            entity.owner = state.players[data["owner"]]
+        if isinstance(entity, PowerUp):
+            entity.effect = data.get("effect") or entity.effect
+        return entity
+
+
+class GameStateSnapshot:
+    def __init__(self, state: GameState):
+        self.level_index = state.level_index
+        self.score = state.score
+        self.lives = state.lives
+        self.paddles = [EntitySnapshot(p) for p in state.paddles]
+        self.balls = [EntitySnapshot(b) for b in state.balls]
+        self.powerups = [EntitySnapshot(p) for p in state.powerups]
+        self.lasers = [EntitySnapshot(l) for l in state.lasers]
+        self.active_effects = [(a.name, a.player.index, a.frames_left) for a in state.active_effects]
+        self.ball_speed_scale = state.ball_speed_scale
+        self.bricks_until_drop = state.bricks_until_drop
+        self.drop_count = state.drop_count
+        self.area = tuple(state.area)
+        self.brick_grids = [GridSnapshot(g) for g in state.brick_grids]
+
+    def restore(self, state: GameState):
+        # Lists are updated in place, rendering layers hold references to them
+        state.level_index = self.level_index
+        state.score = self.score
+        state.lives = self.lives
+        for snapshot, paddle in zip(self.paddles, state.paddles):
+            snapshot.restore_into(paddle)
+        state.balls[:] = [b.restore_into(Ball(Vector2(0, 0)), state) for b in self.balls]
+        state.powerups[:] = [p.restore_into(PowerUp(Vector2(0, 0))) for p in self.powerups]
+        state.lasers[:] = [l.restore_into(Laser(Vector2(0, 0), 0)) for l in self.lasers]
+        state.active_effects[:] = [ActiveEffect(name, state.players[index], frames_left)
+                                   for name, index, frames_left in self.active_effects]
+        state.ball_speed_scale = self.ball_speed_scale
+        state.bricks_until_drop = self.bricks_until_drop
+        state.drop_count = self.drop_count
+        state.area.update(self.area)
+        state.brick_grids[:] = [g.restore() for g in self.brick_grids]
+        state.invalidate_brick_grids()
+        state.collisions.clear()
+        state._is_level_dirty = False
+
+    def as_dict(self) -> dict:
+        return {"level_index": self.level_index,
+                "score": self.score,
+                "lives": self.lives,
+                "paddles": [p.as_dict() for p in self.paddles],
+                "balls": [b.as_dict() for b in self.balls],
+                "powerups": [p.as_dict() for p in self.powerups],
+                "lasers": [l.as_dict() for l in self.lasers],
+                "active_effects": [list(a) for a in self.active_effects],
+                "ball_speed_scale": self.ball_speed_scale,
+                "bricks_until_drop": self.bricks_until_drop,
+                "drop_count": self.drop_count,
+                "area": list(self.area),
+                "brick_grids": [g.as_dict() for g in self.brick_grids]}
+
+    @classmethod
+    def from_dict(cls, data: dict, brick_width: int = 16, brick_height: int = 8):
+        state = GameState()
+        state.verbose = False
+        state.level_index = data["level_index"]
+        state.score = data.get("score", 0)
+        state.lives = data.get("lives", GameState.starting_lives)
+        for _ in data["paddles"][1:]:
+            state.add_player()
+        for paddle, paddle_data in zip(state.paddles, data["paddles"]):
+            EntitySnapshot.load_into(paddle, paddle_data)
+        # The entity lists belong to the store, they are filled in place
+        state.balls[:] = [EntitySnapshot.load_into(Ball(Vector2(0, 0)), b, state) for b in data["balls"]]
+        state.powerups[:] = [EntitySnapshot.load_into(PowerUp(Vector2(0, 0)), p) for p in data["powerups"]]
+        state.lasers[:] = [EntitySnapshot.load_into(Laser(Vector2(0, 0), 0), l) for l in data.get("lasers", [])]
+        state.active_effects = [ActiveEffect(name, state.players[index], frames_left)
+                                for name, index, frames_left in data.get("active_effects", [])]
+        state.ball_speed_scale = data.get("ball_speed_scale", 1.0)
+        state.bricks_until_drop = data.get("bricks_until_drop", state.bricks_until_drop)
+        state.drop_count = data.get("drop_count", 0)
+        state.area.update(data.get("area", state.area))
+        for g in data["brick_grids"]:
+            grid = BrickGrid(g["x"], g["y"], g["width"], brick_width, brick_height, g["env"])
+            for value in g["cells"]:
+                brick = Brick()
+                brick.alive = bool(value)
+                grid.cells.append(brick)
+            state.brick_grids.append(grid)
+        return cls(state)
+
+
+class LevelPack:
+    # Header: magic, version, level count. Index entry: payload offset, compressed size, raw size
+    header = struct.Struct("<4sHI")
+    entry = struct.Struct("<QII")
+    magic = b"BKPK"
+    version = 1
+
+    def __init__(self, path: str):
+        # The whole pack is read once, levels are only decompressed when first requested
+        self.path = path
+        with open(path, mode="rb") as file:
+            self.data = memoryview(file.read())
+        magic, version, self.level_count = self.header.unpack_from(self.data)
+        if magic != self.magic or version != self.version:
+            raise ValueError(f"{path} is not a version {self.version} level pack")
+        self.levels: dict[int, list[dict]] = {}
+
+    def __len__(self):
+        return self.level_count
+
+    def get_level(self, index: int) -> list[dict]:
+        if not 0 <= index < self.level_count:
+            return None
+        if index not in self.levels:
+            offset, size, raw_size = self.entry.unpack_from(self.data, self.header.size + index * self.entry.size)
+            payload = zlib.decompress(self.data[offset:offset + size], bufsize=raw_size)
+            self.levels[index] = json.loads(payload)
+        return self.levels[index]
+
+    def set_level(self, index: int, level: list[dict]):
+        # In memory only, lets the editor reload a level it just saved
+        self.levels[index] = level
+
+    def save_level(self, index: int, level: list[dict]):
+        # The whole pack is rebuilt next to the old one and replaces it in one step
+        if not 0 <= index < self.level_count:
+            raise ValueError(f"{self.path} has no level {index}")
+        self.set_level(index, level)
+        levels = [self.get_level(i) for i in range(self.level_count)]
+        self.build(self.path + ".tmp", levels)
+        os.replace(self.path + ".tmp", self.path)
+
+    @classmethod
+    def build(cls, path: str, levels: list[list[dict]]):
+        payloads = [json.dumps(level, separators=(",", ":")).encode("utf-8") for level in levels]
+        offset = cls.header.size + cls.entry.size * len(payloads)
+        index = []
+        compressed = []
+        for payload in payloads:
+            data = zlib.compress(payload, 9)
+            index.append(cls.entry.pack(offset, len(data), len(payload)))
+            compressed.append(data)
+            offset += len(data)
+        with open(path, mode="wb") as file:
+            file.write(cls.header.pack(cls.magic, cls.version, len(payloads)))
+            file.writelines(index)
+            file.writelines(compressed)
+
+
+class LevelChunkSource:
+    # Provides the grids of an endless level, one chunk of area height at a time
+    def get_chunk(self, index: int) -> list[dict]:
+        raise NotImplementedError()
+
+
+class LevelFileChunkSource(LevelChunkSource):
+    def __init__(self, level_indices: list[int]):
+        self.level_indices = level_indices
+        self.levels: dict[int, list[dict]] = {}
+
+    def get_chunk(self, index: int) -> list[dict]:
+        level_index = self.level_indices[index % len(self.level_indices)]
+        if level_index not in self.levels:
+            level_name: str = "level_" + str(level_index).zfill(2) + ".json"
+            with open(level_name, mode="r", encoding="utf-8") as file:
+                self.levels[level_index] = json.load(file)
+        return self.levels[level_index]
+
+
+class LevelStreamer:
+    def __init__(self, state: GameState, source: LevelChunkSource, scroll_speed: float = 0.125,
+                 look_ahead: int = 1, max_resident_chunks: int = 4):
+        self.state = state
+        self.source = source
+        self.chunk_height = state.area.height
+        self.scroll_speed = scroll_speed
+        self.look_ahead = look_ahead
+        self.max_resident_chunks = max_resident_chunks
+        # Distance the area has scrolled up through the brick field since the start of the level
+        self.scroll = 0
+        self.scroll_remainder = 0.0
+        self.resident_chunks: dict[int, list[BrickGrid]] = {}
+
+    def chunk_top(self, index: int) -> int:
+        return self.state.area.top + self.scroll - index * self.chunk_height
+
+    def advance(self):
+        self.scroll_remainder += self.scroll_speed
+        move = int(self.scroll_remainder)
+        if move != 0:
+            self.scroll_remainder -= move
+            self.scroll_by(move)
+
+    def scroll_by(self, amount: int):
+        # Grids keep their world position, the area moves up with everything in it and the camera follows
+        self.scroll += amount
+        state = self.state
+        state.area.move_ip(0, -amount)
+        for entities in (state.paddles, state.balls, state.powerups, state.lasers):
+            for e in entities:
+                e.rect.move_ip(0, -amount)
+
+    def update(self):
+        # Chunks from the one entering the bottom of the area up to the look ahead limit
+        first = max(0, (self.scroll - self.state.area.height) // self.chunk_height + 1)
+        last = (self.scroll + (self.look_ahead + 1) * self.chunk_height - 1) // self.chunk_height
+        wanted = range(first, last + 1)
+
+        for index in list(self.resident_chunks):
+            if index not in wanted:
+                self.unload_chunk(index)
+        for index in wanted:
+            if index not in self.resident_chunks:
+                self.load_chunk(index)
+
+        # Evict the chunks furthest behind when over budget
+        while len(self.resident_chunks) > self.max_resident_chunks:
+            self.unload_chunk(min(self.resident_chunks))
+
+    def load_chunk(self, index: int):
+        top = self.chunk_top(index)
+        grids = []
+        for data in self.source.get_chunk(index):
+            grid = BrickGrid.from_level_data(data, self.state.brick_width, self.state.brick_height)
+            grid.y += top
+            grids.append(grid)
+        self.resident_chunks[index] = grids
+        self.state.brick_grids.extend(grids)
+        self.state.invalidate_brick_grids()
+
+    def unload_chunk(self, index: int):
+        grids = self.resident_chunks.pop(index)
+        resident = set(map(id, grids))
+        self.state.brick_grids[:] = [g for g in self.state.brick_grids if id(g) not in resident]
+        self.state.invalidate_brick_grids()
+
+
+class FileWatcher:
+    # inotify on the directory of the watched file where available, otherwise polls its modification time
+    inotify_mask = 0x8 | 0x80  # IN_CLOSE_WRITE | IN_MOVED_TO, editors often save by renaming a temporary file
+    inotify_event = struct.Struct("iIII")
+
+    def __init__(self):
+        self.path: str = None
+        self.stamp: tuple[int, int] = None
+        self.libc = None
+        self.fd = -1
+        self.wd = -1
+        self.directory: str = None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            return
+        if fd >= 0:
+            self.libc = libc
+            self.fd = fd
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self.wd >= 0
+
+    def watch(self, path: str):
+        if path == self.path:
+            return
+        self.path = path
+        self.stamp = self.get_stamp()
+        if self.libc is None:
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        if directory != self.directory:
+            if self.wd >= 0:
+                self.libc.inotify_rm_watch(self.fd, self.wd)
+            self.wd = self.libc.inotify_add_watch(self.fd, directory.encode(), self.inotify_mask)
+            self.directory = directory
+
+    def get_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self) -> bool:
+        # True once per change of the watched file
+        if self.path is None:
+            return False
+        if not self.uses_inotify:
+            stamp = self.get_stamp()
+            if stamp == self.stamp:
+                return False
+            self.stamp = stamp
+            return stamp is not None
+
+        changed = False
+        name = os.path.basename(self.path).encode()
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = self.inotify_event.unpack_from(data, offset)
+                offset += self.inotify_event.size
+                changed |= data[offset:offset + length].rstrip(b"\0") == name
+                offset += length
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+            self.wd = -1
+
+
 ###############################################################################
 #                                Commands                                     #
 ###############################################################################
@@ -377,11 +1124,15 @@ class Command:
 
 
 class LaunchBallCommand(Command):
-    def __init__(self, state: GameState):
+    def __init__(self, state: GameState, player: Player = None):
         self.state = state
+        self.player = player or state.players[0]
 
     def run(self):
-        b = self.state.balls[0]
+        balls = self.state.get_player_balls(self.player)
+        if not balls:
+            return
+        b = balls[0]
         b.is_stuck_on_paddle = False
         b.velocity = Vector2(1, -1)
 
@@ -391,12 +1142,57 @@ class CheckForPowerUpCommand(Command):
         self.state = state
 
     def run(self):
-        for p in self.state.powerups[:]:
-            if self.state.paddle.rect.colliderect(p):
-                p.effect.activate(self.state)
-                self.state.powerups.remove(p)
+        # Collected and fallen power-ups are only filtered out of the store when there are some
+        removed = False
+        for p in self.state.powerups:
+            paddle_index = p.rect.collidelist(self.state.paddles)
+            if paddle_index != -1:
+                self.state.activate_effect(p.effect, self.state.players[paddle_index])
+                p.set_alive(False)
+                removed = True
             elif p.rect.top > self.state.area.bottom:
-                self.state.powerups.remove(p)
+                p.set_alive(False)
+                removed = True
+        if removed:
+            self.state.powerups[:] = [p for p in self.state.powerups if p.alive]
+
+
+class UpdateEffectsCommand(Command):
+    def __init__(self, state: GameState):
+        self.state = state
+
+    def run(self):
+        if not self.state.active_effects:
+            return
+        effects = self.state.effect_config.effects
+        for active in self.state.active_effects:
+            effects[active.name].update(self.state, active.player, active)
+            active.frames_left -= 1
+            if active.frames_left <= 0:
+                effects[active.name].deactivate(self.state, active.player)
+        self.state.active_effects[:] = [a for a in self.state.active_effects if a.frames_left > 0]
+
+
+class MoveLasersCommand(Command):
+    def __init__(self, state: GameState):
+        self.state = state
+
+    def run(self):
+        if not self.state.lasers:
+            return
+        for l in self.state.lasers:
+            l.rect.move_ip(l.velocity)
+            if l.rect.bottom < self.state.area.top:
+                l.set_alive(False)
+                continue
+            # Shots move less than a brick per frame, testing their tip is enough
+            for g in self.state.brick_grids:
+                x, y = g.get_cell_coordinates(l.rect.centerx, l.rect.top)
+                if g.is_cell_alive(x, y):
+                    GridCollision.kill_cells(self.state, g, {(x, y)})
+                    l.set_alive(False)
+                    break
+        self.state.lasers[:] = [l for l in self.state.lasers if l.alive]
 
 
 class PaddleMoveCommand(Command):
@@ -423,13 +1219,15 @@ class MovePowerUpsCommand(Command):
 
 
 class InitBallCommand(Command):
-    def __init__(self, state: GameState):
+    def __init__(self, state: GameState, player: Player = None):
         self.state = state
+        self.player = player or state.players[0]
 
     def run(self):
         new_ball = Ball(Vector2(0, 0))
         new_ball.is_stuck_on_paddle = True
-        new_ball.rect.midbottom = self.state.paddle.rect.midtop
+        new_ball.owner = self.player
+        new_ball.rect.midbottom = self.player.paddle.rect.midtop
         self.state.balls.append(new_ball)
         self.state.notify_ball_created(new_ball)
 
@@ -441,20 +1239,23 @@ class MoveBallsCommand(Command):
     def run(self):
         for b in self.state.balls:
             if b.is_stuck_on_paddle:
-                b.rect.midbottom = self.state.paddle.rect.midtop
+                b.rect.midbottom = b.owner.paddle.rect.midtop
                 continue
             self.move_y(b)
             self.move_x(b)
             if not self.state.area.colliderect(b.rect):
                 self.state.notify_ball_lost(b)
                 self.state.balls.remove(b)
+                if not self.state.get_player_balls(b.owner):
+                    self.state.lives -= 1
+                    self.state.notify_last_ball_lost()
 
     def collide_x(self, ball: Ball, x_direction):
         axis = Vector2(1, 0)
         next_rect = ball.rect.move(x_direction, 0)
 
-        # Paddle
-        if self.state.paddle is not None and next_rect.colliderect(self.state.paddle):
+        # Paddles of every player in one test
+        if next_rect.collidelist(self.state.paddles) != -1:
             self.state.collisions.append(BallCollision(self.state, ball, axis))
             return True
 
@@ -488,9 +1289,11 @@ class MoveBallsCommand(Command):
         collide = False
         ball_rect = ball.rect.move(0, y_direction)
 
-        # Paddle
-        if self.state.paddle is not None and ball_rect.colliderect(self.state.paddle):
-            self.state.collisions.append(BallCollisionWithPaddle(self.state, ball, axis, self.state.paddle))
+        # Paddles of every player in one test
+        paddle_index = ball_rect.collidelist(self.state.paddles)
+        if paddle_index != -1:
+            paddle = self.state.paddles[paddle_index]
+            self.state.collisions.append(BallCollisionWithPaddle(self.state, ball, axis, paddle))
             return True
 
         # Area Boundaries
@@ -517,7 +1320,7 @@ class MoveBallsCommand(Command):
         return collide
 
     def move_x(self, ball):
-        ball.movement_remainder.x += ball.velocity.x
+        ball.movement_remainder.x += ball.velocity.x * self.state.ball_speed_scale
         move: int = round(ball.movement_remainder.x)
         if move == 0:
             return
@@ -530,7 +1333,7 @@ class MoveBallsCommand(Command):
             ball.rect.move_ip(sign, 0)
 
     def move_y(self, ball):
-        ball.movement_remainder.y += ball.velocity.y
+        ball.movement_remainder.y += ball.velocity.y * self.state.ball_speed_scale
         move: int = round(ball.movement_remainder.y)
         if move == 0:
             return
@@ -548,20 +1351,129 @@ class RunCollisionsCommand(Command):
         self.state: GameState = state
 
     def run(self):
+        # Coalesce the frame's events: one reflection per ball and axis, one kill pass per grid
+        reflections: dict[tuple[int, float, float], Collision] = {}
+        grid_hits: dict[int, tuple[BrickGrid, set[tuple[int, int]]]] = {}
         for c in self.state.collisions:
+            if isinstance(c, GridCollision):
+                _, cells = grid_hits.setdefault(id(c.brick_grid), (c.brick_grid, set()))
+                cells.update((x, y) for x, y, _ in c.hit_cells)
+            else:
+                reflections.setdefault((id(c.collider), c.axis.x, c.axis.y), c)
+
+        for c in reflections.values():
             c.process()
+        for brick_grid, cells in grid_hits.values():
+            GridCollision.kill_cells(self.state, brick_grid, cells)
         self.state.collisions.clear()
 
 
-class DestroyBrickCommand(Command):
-    def __init__(self, brick_grids: list[BrickGrid], position: Vector2):
-        self.brick_grids = brick_grids
+class UndoableCommand(Command):
+    def undo(self):
+        raise NotImplementedError()
+
+    def redo(self):
+        self.run()
+
+    @property
+    def memory_size(self) -> int:
+        return 64
+
+
+class CommandHistory:
+    def __init__(self, max_entries: int = 1000, memory_budget: int = 4 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.undo_stack: deque[UndoableCommand] = deque()
+        self.redo_stack: list[UndoableCommand] = []
+
+    def push(self, command: UndoableCommand):
+        self.undo_stack.append(command)
+        self.memory_used += command.memory_size
+        for c in self.redo_stack:
+            self.memory_used -= c.memory_size
+        self.redo_stack.clear()
+
+        # Forget the oldest entries once over budget
+        while self.undo_stack and (len(self.undo_stack) > self.max_entries or
+                                   self.memory_used > self.memory_budget):
+            self.memory_used -= self.undo_stack.popleft().memory_size
+
+    def undo(self):
+        if not self.undo_stack:
+            return
+        command = self.undo_stack.pop()
+        command.undo()
+        self.redo_stack.append(command)
+
+    def redo(self):
+        if not self.redo_stack:
+            return
+        command = self.redo_stack.pop()
+        command.redo()
+        self.undo_stack.append(command)
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.memory_used = 0
+
+
+class UndoCommand(Command):
+    def __init__(self, history: CommandHistory):
+        self.history = history
+
+    def run(self):
+        self.history.undo()
+
+
+class RedoCommand(Command):
+    def __init__(self, history: CommandHistory):
+        self.history = history
+
+    def run(self):
+        self.history.redo()
+
+
+class DestroyBrickCommand(UndoableCommand):
+    def __init__(self, game_state: GameState, brick_grids: list[BrickGrid], position: Vector2):
+        self.game_state = game_state
+        self.brick_grids = brick_grids[:]
         self.position = position
+        # Grid, bounds at the time of the kill and index of the killed cell within those bounds
+        self.killed_cells: list[tuple[BrickGrid, tuple[int, int, int, int], int]] = []
 
     def run(self):
+        self.killed_cells.clear()
         for bg in self.brick_grids:
+            x, y = bg.get_cell_coordinates(int(self.position.x), int(self.position.y))
+            if bg.is_cell_alive(x, y):
+                self.killed_cells.append((bg, bg.get_bounds(), x + y * bg.width))
             bg.kill_cell_world(self.position)
 
+    def undo(self):
+        for bg, bounds, index in reversed(self.killed_cells):
+            bg.expand(*bounds)
+            x, y = self.cell_world_position(bg, bounds, index)
+            bg.revive_cell(*bg.get_cell_coordinates(x, y))
+            if bg not in self.game_state.brick_grids:
+                self.game_state.brick_grids.append(bg)
+        self.game_state.invalidate_brick_grids()
+
+    def redo(self):
+        for bg, bounds, index in self.killed_cells:
+            bg.kill_cell_world(Vector2(self.cell_world_position(bg, bounds, index)))
+
+    @staticmethod
+    def cell_world_position(grid: Grid, bounds: tuple[int, int, int, int], index: int) -> tuple[int, int]:
+        x, y, width, _ = bounds
+        return x + index % width * grid.cell_width, y + index // width * grid.cell_height
+
+    @property
+    def memory_size(self) -> int:
+        return 64 + 48 * len(self.killed_cells)
+
 
 class EditBrickGrid(Command):
     def __init__(self, state, value, rect):
@@ -573,10 +1485,11 @@ class EditBrickGrid(Command):
         pass
 
 
-class CreateBrickGrid(Command):
+class CreateBrickGrid(UndoableCommand):
     def __init__(self, state, rect):
         self.state: GameState = state
         self.rect: Rect = rect
+        self.new_grid: BrickGrid = None
 
     def run(self):
         x = self.rect.left // self.state.brick_width
@@ -588,15 +1501,46 @@ class CreateBrickGrid(Command):
                              self.state.brick_height, 1)
         new_grid.cells = [Brick() for _ in range(w * h)]
         self.state.brick_grids.append(new_grid)
+        self.state.invalidate_brick_grids()
+        self.new_grid = new_grid
 
+    def undo(self):
+        if self.new_grid in self.state.brick_grids:
+            self.state.brick_grids.remove(self.new_grid)
+            self.state.invalidate_brick_grids()
+            self.state.notify_brick_grid_destroyed(self.new_grid)
 
-class DestroyBrickGridCommand(Command):
+    def redo(self):
+        self.state.brick_grids.append(self.new_grid)
+        self.state.invalidate_brick_grids()
+
+    @property
+    def memory_size(self) -> int:
+        # Once undone the created grid is only kept alive by this entry
+        if self.new_grid is None:
+            return 64
+        return 128 + 8 * len(self.new_grid.cells)
+
+
+class DestroyBrickGridCommand(UndoableCommand):
     def __init__(self, game_state: GameState, brick_grid: BrickGrid):
         self.game_state: GameState = game_state
         self.brick_grid = brick_grid
+        self.index = 0
 
     def run(self):
+        self.index = self.game_state.brick_grids.index(self.brick_grid)
         self.game_state.brick_grids.remove(self.brick_grid)
+        self.game_state.invalidate_brick_grids()
+
+    def undo(self):
+        self.game_state.brick_grids.insert(self.index, self.brick_grid)
+        self.game_state.invalidate_brick_grids()
+
+    @property
+    def memory_size(self) -> int:
+        # The removed grid is only kept alive by this entry
+        return 128 + 8 * len(self.brick_grid.cells)
 
 
 class BrickGridMaintenanceCommand(Command):
@@ -612,9 +1556,19 @@ class BrickGridMaintenanceCommand(Command):
                 self.game_state.brick_grids.remove(bg)
                 self.game_state.notify_brick_grid_destroyed(bg)
 
+        self.game_state.invalidate_brick_grids()
         self.game_state._is_level_dirty = False
 
 
+class StreamLevelCommand(Command):
+    def __init__(self, streamer: LevelStreamer):
+        self.streamer = streamer
+
+    def run(self):
+        self.streamer.advance()
+        self.streamer.update()
+
+
 class CheckForEndOfLevelCommand(Command):
     def __init__(self, game_state: GameState):
         self.game_state = game_state
@@ -640,16 +1594,22 @@ class UnloadLevelCommand(Command):
 
     def run(self):
         self.state.brick_grids.clear()
+        self.state.invalidate_brick_grids()
+        self.state.clear_effects()
+        self.state.notify_level_unloaded()
 
 
 class ClearBallsCommand(Command):
-    def __init__(self, state: GameState):
+    def __init__(self, state: GameState, player: Player = None):
         self.state = state
+        self.player = player
 
     def run(self):
+        # Clears the balls of one player, or every ball when no player is given
         for b in self.state.balls:
-            b.set_alive(False)
-        self.state.balls.clear()
+            if self.player is None or b.owner is self.player:
+                b.set_alive(False)
+        self.state.balls[:] = [b for b in self.state.balls if b.alive]
         self.state.notify_balls_cleared()
 
 
@@ -658,22 +1618,73 @@ class LoadLevelCommand(Command):
         self.state: GameState = state
 
     def run(self):
+        if self.state.level_pack is not None:
+            level = self.state.level_pack.get_level(self.state.level_index)
+            if level is None:
+                print("Level pack has no level", self.state.level_index)
+                return
+            self.add_grids(level)
+            return
+
         level_name: str = "level_" + str(self.state.level_index).zfill(2) + ".json"
         try:
             file = open(level_name, mode="r", encoding="utf-8")
-            level = json.load(file)
-            for brick_grid in level:
-                x = brick_grid["x"]
-                y = brick_grid["y"]
-                w = brick_grid["width"]
-                env = brick_grid["env"]
-                new_grid: BrickGrid = BrickGrid(x, y, w, self.state.brick_width, self.state.brick_height, env)
-                for count, value in enumerate(brick_grid["cells"]):
-                    new_grid.cells.append(Brick())
-                self.state.brick_grids.append(new_grid)
+            self.add_grids(json.load(file))
         except OSError as error:
             print("OS error:", error)
 
+    def add_grids(self, level: list[dict]):
+        for brick_grid in level:
+            new_grid = BrickGrid.from_level_data(brick_grid, self.state.brick_width, self.state.brick_height)
+            self.state.brick_grids.append(new_grid)
+        self.state.invalidate_brick_grids()
+        self.state.notify_level_loaded()
+
+
+class ReloadLevelCommand(Command):
+    # Turns the live brick grids into the level data with as few changes as possible
+    def __init__(self, state: GameState, level: list[dict]):
+        self.state = state
+        self.level = level
+
+    def run(self):
+        # Grids are matched by position and size, matched grids only get their differing cells written
+        live: dict[tuple[int, int, int, int], list[BrickGrid]] = {}
+        for g in self.state.brick_grids:
+            live.setdefault((g.x, g.y, g.width, g.height), []).append(g)
+
+        grids: list[BrickGrid] = []
+        added = 0
+        patched = 0
+        for data in self.level:
+            key = (data["x"], data["y"], data["width"], len(data["cells"]) // data["width"])
+            candidates = live.get(key)
+            if not candidates:
+                grids.append(BrickGrid.from_level_data(data, self.state.brick_width, self.state.brick_height))
+                added += 1
+                continue
+            g = candidates.pop(0)
+            # Level files load every cell alive, a reload has to end up with the same grids as a fresh load
+            changed = g.set_cells_alive([1] * len(data["cells"]))
+            if g.environment != data["env"]:
+                g.environment = data["env"]
+                changed += 1
+            patched += changed > 0
+            grids.append(g)
+
+        removed = [g for candidates in live.values() for g in candidates]
+        if added or removed or any(a is not b for a, b in zip(grids, self.state.brick_grids)):
+            self.state.brick_grids[:] = grids
+            self.state.invalidate_brick_grids()
+            for g in removed:
+                self.state.notify_brick_grid_destroyed(g)
+        elif not patched:
+            # Typically the editor saving the level it shows
+            return
+
+        self.state.log(f"Level Reloaded: {added} added, {len(removed)} removed, {patched} patched")
+        self.state.notify_level_reloaded()
+
 
 class SaveLevelCommand(Command):
     def __init__(self, state):
@@ -687,6 +1698,14 @@ class SaveLevelCommand(Command):
             cells: list[int] = [int(c) for c in g.cells]
             level.append({"x": g.x, "y": g.y, "width": g.width, "env": g.environment, "cells": cells})
 
+        # Packed levels are saved into the pack, the next run loads them from there
+        if self.state.level_pack is not None:
+            try:
+                self.state.level_pack.save_level(self.state.level_index, level)
+            except (OSError, ValueError) as error:
+                print("Level pack error:", error)
+            return
+
         try:
             write_file = open(level_name, mode="w", encoding="utf-8")
             json.dump(level, write_file, indent=4)
@@ -694,15 +1713,360 @@ class SaveLevelCommand(Command):
             print("OS error:", error)
 
 
-class ChangeBrickGridEnvironmentCommand(Command):
+class RestoreGameStateCommand(Command):
+    def __init__(self, state: GameState, snapshot: GameStateSnapshot):
+        self.state = state
+        self.snapshot = snapshot
+
+    def run(self):
+        self.state.restore(self.snapshot)
+
+
+class ChangeBrickGridEnvironmentCommand(UndoableCommand):
     def __init__(self, brick_grid: list[BrickGrid], increment: int):
-        self.brickGrid: list[BrickGrid] = brick_grid
+        self.brickGrid: list[BrickGrid] = brick_grid[:]
         self.increment = increment
+        self.previous_environments: list[int] = []
 
     def run(self):
+        self.previous_environments = [bg.environment for bg in self.brickGrid]
         for bg in self.brickGrid:
             bg.environment = abs(bg.environment + self.increment) % bg.environment_count
 
+    def undo(self):
+        for bg, environment in zip(self.brickGrid, self.previous_environments):
+            bg.environment = environment
+
+
+###############################################################################
+#                                  Input                                      #
+###############################################################################
+
+class FrameInput:
+    launch_flag = 1
+    clear_flag = 2
+
+    def __init__(self, move_amount: float = 0, launch: bool = False, clear: bool = False):
+        self.move_amount = move_amount
+        self.launch = launch
+        self.clear = clear
+
+    @property
+    def flags(self) -> int:
+        return FrameInput.launch_flag * self.launch | FrameInput.clear_flag * self.clear
+
+    @classmethod
+    def from_flags(cls, move_amount: float, flags: int):
+        return cls(move_amount, bool(flags & cls.launch_flag), bool(flags & cls.clear_flag))
+
+    def __eq__(self, other):
+        return isinstance(other, FrameInput) and (self.move_amount, self.flags) == (other.move_amount, other.flags)
+
+
+class InputSource:
+    def next_input(self, state: GameState, player: Player) -> FrameInput:
+        raise NotImplementedError()
+
+
+class KeyboardInputSource(InputSource):
+    def __init__(self, left_key: int, right_key: int, launch_key: int):
+        self.left_key = left_key
+        self.right_key = right_key
+        self.launch_key = launch_key
+        self.launch_was_pressed = False
+
+    def next_input(self, state: GameState, player: Player) -> FrameInput:
+        keys = pygame.key.get_pressed()
+        frame_input = FrameInput((-keys[self.left_key] + keys[self.right_key]) * Paddle.speed)
+        frame_input.launch = keys[self.launch_key] and not self.launch_was_pressed
+        self.launch_was_pressed = keys[self.launch_key]
+        return frame_input
+
+
+class InputLog:
+    # Header: magic, version, starting level index, player count. Version 1 logs have no player count
+    header = struct.Struct("<4sHHB")
+    header_v1 = struct.Struct("<4sHH")
+    # Player after the first: kind (keyboard or a paddle policy) and seed
+    player = struct.Struct("<12sI")
+    # Frame: paddle delta, launch/clear flags, once per player
+    frame = struct.Struct("<fB")
+    magic = b"BKIN"
+    version = 2
+
+    @staticmethod
+    def quantize(frame_input: FrameInput) -> FrameInput:
+        # The value the log stores, a recorded session has to simulate exactly what it replays
+        return FrameInput.from_flags(*InputLog.frame.unpack(InputLog.frame.pack(frame_input.move_amount,
+                                                                               frame_input.flags)))
+
+
+class InputRecorder(InputLog):
+    def __init__(self, path: str, level_index: int, players: list[tuple[str, int]] = ()):
+        # players: kind and seed of every player after the first
+        self.file = open(path, mode="wb")
+        self.file.write(self.header.pack(self.magic, self.version, level_index, len(players) + 1))
+        for kind, seed in players:
+            self.file.write(self.player.pack(kind.encode("ascii"), seed))
+        self.frame_count = 0
+
+    def write(self, frame_inputs: list[FrameInput]):
+        for frame_input in frame_inputs:
+            self.file.write(self.frame.pack(frame_input.move_amount, frame_input.flags))
+        self.frame_count += 1
+
+    def close(self):
+        self.file.close()
+
+
+class InputReplay(InputLog):
+    def __init__(self, path: str):
+        with open(path, mode="rb") as file:
+            data = file.read()
+        magic, version, self.level_index = self.header_v1.unpack_from(data)
+        if magic != self.magic or version not in (1, self.version):
+            raise ValueError(f"{path} is not a version 1 or {self.version} input log")
+        self.players: list[tuple[str, int]] = []
+        offset = self.header_v1.size
+        player_count = 1
+        if version >= 2:
+            player_count = self.header.unpack_from(data)[3]
+            offset = self.header.size
+            for _ in range(player_count - 1):
+                kind, seed = self.player.unpack_from(data, offset)
+                self.players.append((kind.rstrip(b"\0").decode("ascii"), seed))
+                offset += self.player.size
+        self.player_count = player_count
+        self.data = memoryview(data)[offset:]
+
+    def __len__(self):
+        return len(self.data) // (self.frame.size * self.player_count)
+
+    def __iter__(self):
+        # One input per player and frame
+        frame_inputs = []
+        for move_amount, flags in self.frame.iter_unpack(self.data):
+            frame_inputs.append(FrameInput.from_flags(move_amount, flags))
+            if len(frame_inputs) == self.player_count:
+                yield frame_inputs
+                frame_inputs = []
+
+
+###############################################################################
+#                                Networking                                   #
+###############################################################################
+
+def parse_address(text: str) -> tuple[str, int]:
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class NetProtocol:
+    # Header: magic, message type, player index, acknowledged frame, first frame, input count. Followed by the
+    # inputs of consecutive frames, packed like the frames of an input log
+    header = struct.Struct("<4sBBiiB")
+    magic = b"BKNT"
+    hello_message = 0
+    start_message = 1
+    inputs_message = 2
+    max_inputs = 32
+
+    @classmethod
+    def pack(cls, message_type: int, player_index: int = 0, ack: int = -1, first_frame: int = 0,
+             inputs: list[FrameInput] = ()) -> bytes:
+        data = [cls.header.pack(cls.magic, message_type, player_index, ack, first_frame, len(inputs))]
+        data.extend(InputLog.frame.pack(i.move_amount, i.flags) for i in inputs)
+        return b"".join(data)
+
+    @classmethod
+    def unpack(cls, data: bytes):
+        # None for anything that is not a well formed message
+        if len(data) < cls.header.size:
+            return None
+        magic, message_type, player_index, ack, first_frame, count = cls.header.unpack_from(data)
+        if magic != cls.magic or len(data) != cls.header.size + count * InputLog.frame.size:
+            return None
+        inputs = [FrameInput.from_flags(m, f) for m, f in InputLog.frame.iter_unpack(data[cls.header.size:])]
+        return message_type, player_index, ack, first_frame, inputs
+
+
+class RelayServer(NetProtocol):
+    # Pairs the first clients to say hello and forwards their input messages to each other
+    def __init__(self, address: tuple[str, int], player_count: int = 2):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.socket.settimeout(0.5)
+        self.player_count = player_count
+        self.peers: list[tuple[str, int]] = []
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                data, address = self.socket.recvfrom(2048)
+            except socket.timeout:
+                continue
+            message = self.unpack(data)
+            if message is None:
+                continue
+            if message[0] == self.hello_message:
+                if address not in self.peers and len(self.peers) < self.player_count:
+                    self.peers.append(address)
+                    print(f"Player {len(self.peers) - 1} joined from {address[0]}:{address[1]}")
+                # Hellos keep coming until the start message arrives, so a lost one is sent again
+                if len(self.peers) == self.player_count and address in self.peers:
+                    self.socket.sendto(self.pack(self.start_message, self.peers.index(address)), address)
+            elif message[0] == self.inputs_message and address in self.peers:
+                for peer in self.peers:
+                    if peer != address:
+                        self.socket.sendto(data, peer)
+        self.socket.close()
+
+
+class LockstepSession(NetProtocol):
+    # Both players simulate the same game from the same inputs. Local inputs are delayed a few frames to give
+    # them time to arrive, missing remote inputs are predicted and the frames are simulated again when the
+    # prediction turns out wrong
+    def __init__(self, play_game_mode, address: tuple[str, int], input_delay: int = 2, max_rollback: int = 12,
+                 timeout: float = 30.0):
+        self.play_game_mode = play_game_mode
+        self.state: GameState = play_game_mode.game_state
+        self.address = address
+        self.input_delay = input_delay
+        self.max_rollback = max_rollback
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.local_index = self.connect(timeout)
+        self.remote_index = 1 - self.local_index
+        self.socket.setblocking(False)
+
+        self.frame = 0
+        self.local_inputs: dict[int, FrameInput] = {f: FrameInput() for f in range(input_delay)}
+        self.remote_inputs: dict[int, FrameInput] = {}
+        self.used_remote_inputs: dict[int, FrameInput] = {}
+        self.snapshots: dict[int, tuple[GameStateSnapshot, bool]] = {}
+        # Every remote input up to remote_confirmed arrived, every local one up to remote_ack was received
+        self.remote_confirmed = -1
+        self.remote_ack = -1
+        self.rollback_frame: int = None
+        self.rollback_count = 0
+        self.stall_count = 0
+
+    def connect(self, timeout: float) -> int:
+        self.socket.settimeout(0.25)
+        deadline = perf_counter() + timeout
+        while perf_counter() < deadline:
+            self.socket.sendto(self.pack(self.hello_message), self.address)
+            try:
+                data, _ = self.socket.recvfrom(2048)
+            except OSError:
+                continue
+            message = self.unpack(data)
+            if message is not None and message[0] == self.start_message:
+                return message[1]
+        raise ConnectionError(f"No game started by the relay at {self.address[0]}:{self.address[1]}")
+
+    @staticmethod
+    def quantize(frame_input: FrameInput) -> FrameInput:
+        # The other player receives the packed input, both sides must simulate the exact same value
+        return InputLog.quantize(frame_input)
+
+    def predict(self, frame: int) -> FrameInput:
+        # The paddle keeps moving like it last did, one-shot actions are not repeated
+        frame_input = self.remote_inputs.get(frame)
+        if frame_input is not None:
+            return frame_input
+        last = self.remote_inputs.get(self.remote_confirmed)
+        return FrameInput(last.move_amount) if last is not None else FrameInput()
+
+    def receive(self):
+        while True:
+            try:
+                data, _ = self.socket.recvfrom(2048)
+            except BlockingIOError:
+                return
+            message = self.unpack(data)
+            if message is None or message[0] != self.inputs_message or message[1] != self.remote_index:
+                continue
+            _, _, ack, first_frame, inputs = message
+            self.remote_ack = max(self.remote_ack, ack)
+            for frame, frame_input in enumerate(inputs, first_frame):
+                if frame <= self.remote_confirmed or frame in self.remote_inputs:
+                    continue
+                self.remote_inputs[frame] = frame_input
+                used = self.used_remote_inputs.get(frame)
+                if used is not None and used != frame_input:
+                    self.rollback_frame = frame if self.rollback_frame is None else min(self.rollback_frame, frame)
+            while self.remote_confirmed + 1 in self.remote_inputs:
+                self.remote_confirmed += 1
+
+    def send(self):
+        # Everything the other player has not acknowledged yet, a lost message is covered by the next one
+        first = self.remote_ack + 1
+        last = min(self.frame + self.input_delay - 1, first + self.max_inputs - 1)
+        inputs = [self.local_inputs[f] for f in range(first, last + 1)]
+        self.socket.sendto(self.pack(self.inputs_message, self.local_index, self.remote_confirmed, first, inputs),
+                           self.address)
+
+    def simulate(self, frame: int):
+        # Queues the commands of the frame, the caller runs them
+        frame_inputs = [FrameInput(), FrameInput()]
+        frame_inputs[self.local_index] = self.local_inputs[frame]
+        frame_inputs[self.remote_index] = self.used_remote_inputs[frame] = self.predict(frame)
+        self.snapshots[frame] = (self.state.snapshot(), self.play_game_mode.level_clear)
+        self.play_game_mode.apply_frame_inputs(frame_inputs)
+
+    def rollback(self):
+        # Back to the first mispredicted frame, then forward again through the regular command pipeline
+        frame = self.rollback_frame
+        self.rollback_frame = None
+        self.rollback_count += 1
+        snapshot, level_clear = self.snapshots[frame]
+        # Not GameState.restore: observers are not told, so debris and the editor history survive the rollback
+        snapshot.restore(self.state)
+        self.play_game_mode.level_clear = level_clear
+        self.play_game_mode.commands.clear()
+
+        # The debris of the re-simulated frames was emitted when they were first predicted
+        particle_layer = self.play_game_mode.particle_layer
+        emitting = particle_layer.emitting
+        particle_layer.emitting = False
+        for f in range(frame, self.frame):
+            self.simulate(f)
+            self.play_game_mode.update()
+        particle_layer.emitting = emitting
+
+    def sync(self):
+        self.receive()
+        if self.rollback_frame is not None:
+            self.rollback()
+
+    def advance(self, frame_input: FrameInput) -> bool:
+        # Returns False when the frame has to wait for the other player
+        self.sync()
+        if self.frame - self.remote_confirmed > self.max_rollback:
+            self.stall_count += 1
+            self.send()
+            return False
+        self.local_inputs[self.frame + self.input_delay] = self.quantize(frame_input)
+        self.simulate(self.frame)
+        self.frame += 1
+        self.send()
+
+        # Simulated frames with confirmed inputs are never simulated again, the other player can be ahead
+        done = min(self.remote_confirmed, self.frame - 1)
+        for frames in (self.snapshots, self.used_remote_inputs):
+            for f in [f for f in frames if f <= done]:
+                del frames[f]
+        for f in [f for f in self.remote_inputs if f < done]:
+            del self.remote_inputs[f]
+        for f in [f for f in self.local_inputs if f <= min(done, self.remote_ack)]:
+            del self.local_inputs[f]
+        return True
+
+    def close(self):
+        self.socket.close()
+
 
 ###############################################################################
 #                                Rendering                                    #
@@ -711,6 +2075,21 @@ class Viewport:
     def __init__(self, size, scale):
         self.surface: Surface = Surface(size)
         self.scale: int = scale
+        # World space rectangle shown by the viewport
+        self.camera: Rect = Rect((0, 0), size)
+
+    def move_camera(self, x: int, y: int, bounds: Rect = None):
+        self.camera.topleft = (x, y)
+        if bounds is not None:
+            self.camera.clamp_ip(bounds)
+
+    def world_to_view(self, rect: Rect) -> Rect:
+        return rect.move(-self.camera.x, -self.camera.y)
+
+    @property
+    def visible_rect(self) -> Rect:
+        # Camera restricted to the surface clip, layers cull against it
+        return self.surface.get_clip().move(self.camera.topleft)
 
     def clear(self):
         self.surface.fill(0x326441)
@@ -722,11 +2101,11 @@ class Viewport:
 
     @property
     def mouse_x(self) -> int:
-        return pygame.mouse.get_pos()[0] // self.scale
+        return pygame.mouse.get_pos()[0] // self.scale + self.camera.x
 
     @property
     def mouse_y(self) -> int:
-        return pygame.mouse.get_pos()[1] // self.scale
+        return pygame.mouse.get_pos()[1] // self.scale + self.camera.y
 
     @property
     def mouse(self) -> Vector2:
@@ -735,15 +2114,41 @@ class Viewport:
     def render(self, window: Surface):
         window.blit(pygame.transform.scale_by(self.surface, self.scale), window.get_rect())
 
+    def render_rects(self, window: Surface, rects: list[Rect]) -> list[Rect]:
+        window_rects = []
+        for r in rects:
+            window_rect = Rect(r.x * self.scale, r.y * self.scale, r.w * self.scale, r.h * self.scale)
+            window.blit(pygame.transform.scale(self.surface.subsurface(r), window_rect.size), window_rect)
+            window_rects.append(window_rect)
+        return window_rects
+
+    @staticmethod
+    def merge_rects(rects: list[Rect]) -> list[Rect]:
+        merged: list[Rect] = []
+        for r in rects:
+            r = r.copy()
+            # Absorb every merged rect touching this one until none is left
+            index = r.collidelist([m.inflate(2, 2) for m in merged])
+            while index != -1:
+                r.union_ip(merged.pop(index))
+                index = r.collidelist([m.inflate(2, 2) for m in merged])
+            merged.append(r)
+        return merged
+
 
 class RenderingLayer(GameStateObserver):
     def render(self, viewport: Viewport):
         raise NotImplementedError()
 
+    def collect_dirty_rects(self, viewport: Viewport) -> list[Rect]:
+        # View space regions that changed since the previous call
+        raise NotImplementedError()
+
 
 class EntityLayer(RenderingLayer):
     def __init__(self):
         self.entities: list[Entity] = []
+        self.previous_rects: set[tuple[int, int, int, int]] = set()
 
     def on_ball_created(self, ball):
         self.entities.append(ball)
@@ -755,31 +2160,72 @@ class EntityLayer(RenderingLayer):
         self.entities = [e for e in self.entities if e.alive]
 
     def render(self, viewport: Viewport):
-        # Render entities
+        # Render entities inside the camera
+        camera = viewport.camera
+        visible = viewport.visible_rect
         for e in self.entities:
-            pygame.draw.rect(viewport.surface, 'white', e.rect)
+            if visible.colliderect(e.rect):
+                pygame.draw.rect(viewport.surface, 'white', e.rect.move(-camera.x, -camera.y))
+
+    def collect_dirty_rects(self, viewport: Viewport) -> list[Rect]:
+        # Old and new position of every entity that moved, appeared or vanished
+        rects = {tuple(viewport.world_to_view(e.rect)) for e in self.entities}
+        dirty = [Rect(r) for r in rects ^ self.previous_rects]
+        self.previous_rects = rects
+        return dirty
 
 
 class TileLayer(RenderingLayer):
     def __init__(self, grids):
         self.grids: list[BrickGrid] = grids  # This is a reference to the game state list of Brick Grids
-        files = ["tiles_dual_16_8_forest.png"]
-        self.tile_sets = []
-        for f in files:
-            i = pygame.image.load(f)
-            i.set_colorkey((0, 0, 0))
-            self.tile_sets.append(i)
+        self.previous_grids: dict[int, tuple[tuple, Rect]] = {}
+        # Looked up at render time so the display converted version is used once it exists
+        self.tile_set_files = ["tiles_dual_16_8_forest.png"]
 
     def render(self, viewport: Viewport):
         self.render_auto_tile(viewport)
         return
 
+    def collect_dirty_rects(self, viewport: Viewport) -> list[Rect]:
+        # Tile footprint of every grid that was added, removed, moved or had cells changed
+        dirty = []
+        grids = {}
+        for g in self.grids:
+            signature = (g.x, g.y, g.width, g.height, g.environment, g.revision)
+            previous = self.previous_grids.get(id(g))
+            if previous is not None and previous[0] == signature:
+                grids[id(g)] = previous
+                continue
+            footprint = viewport.world_to_view(g.get_rect().inflate(g.cell_width, g.cell_height))
+            grids[id(g)] = (signature, footprint)
+            dirty.append(footprint)
+            if previous is not None:
+                dirty.append(previous[1])
+        for key, previous in self.previous_grids.items():
+            if key not in grids:
+                dirty.append(previous[1])
+        self.previous_grids = grids
+        return dirty
+
     def render_auto_tile(self, viewport: Viewport):
+        tile_set = resources.image(self.tile_set_files[0], (0, 0, 0))
+        camera = viewport.camera
+        visible = viewport.visible_rect
         for g in self.grids:
-            for x in range(-1, g.width):
-                for y in range(-1, g.height):
-                    draw_x = x * g.cell_width + g.x + (g.cell_width / 2)
-                    draw_y = y * g.cell_height + g.y + (g.cell_height / 2)
+            # Tiles sit half a cell off the grid, so they overhang it by half a cell on every side
+            if not g.get_rect().inflate(g.cell_width, g.cell_height).colliderect(visible):
+                continue
+
+            # Only the columns and rows of tiles that overlap the camera
+            x_start = max(-1, (visible.left - g.x) // g.cell_width - 2)
+            x_end = min(g.width, (visible.right - g.x) // g.cell_width + 1)
+            y_start = max(-1, (visible.top - g.y) // g.cell_height - 2)
+            y_end = min(g.height, (visible.bottom - g.y) // g.cell_height + 1)
+
+            for x in range(x_start, x_end):
+                for y in range(y_start, y_end):
+                    draw_x = x * g.cell_width + g.x + (g.cell_width / 2) - camera.x
+                    draw_y = y * g.cell_height + g.y + (g.cell_height / 2) - camera.y
                     draw_w = g.cell_width
                     draw_h = g.cell_height
 
@@ -796,7 +2242,286 @@ class TileLayer(RenderingLayer):
                     dest = Rect(draw_x, draw_y, draw_w, draw_h)
                     area = Rect(value * g.cell_width, g.environment * g.cell_height, g.cell_width, g.cell_height)
 
-                    viewport.surface.blit(self.tile_sets[0], dest, area)
+                    viewport.surface.blit(tile_set, dest, area)
+
+
+class ParticleSystem:
+    # Fixed capacity ring buffer, once full new particles overwrite the oldest ones
+    gravity = 0.08
+    palette = [(132, 186, 60), (88, 140, 44), (120, 92, 52), (72, 60, 40)]
+
+    def __init__(self, capacity: int = 32768, seed: int = None):
+        self.capacity = capacity
+        self.head = 0
+        self.alive_count = 0
+        # Separate generator, debris must not change the random sequence of the game
+        if numpy is not None:
+            self.rng = numpy.random.default_rng(seed)
+            self.x = numpy.zeros(capacity, dtype=numpy.float32)
+            self.y = numpy.zeros(capacity, dtype=numpy.float32)
+            self.vx = numpy.zeros(capacity, dtype=numpy.float32)
+            self.vy = numpy.zeros(capacity, dtype=numpy.float32)
+            self.life = numpy.zeros(capacity, dtype=numpy.int16)
+            self.color = numpy.zeros(capacity, dtype=numpy.uint8)
+        else:
+            self.rng = random.Random(seed)
+            self.x = array("f", bytes(4 * capacity))
+            self.y = array("f", bytes(4 * capacity))
+            self.vx = array("f", bytes(4 * capacity))
+            self.vy = array("f", bytes(4 * capacity))
+            self.life = array("h", bytes(2 * capacity))
+            self.color = array("B", bytes(capacity))
+
+    def emit(self, rects: list[Rect], per_rect: int = 8, life: tuple[int, int] = (20, 40)):
+        # Spawns particles spread over every rect, flying up and outwards
+        count = min(len(rects) * per_rect, self.capacity)
+        if count == 0:
+            return
+        rects = rects[-(count // per_rect):]
+        if numpy is not None:
+            origin = numpy.repeat(numpy.array([tuple(r) for r in rects], dtype=numpy.float32), per_rect, axis=0)
+            index = (self.head + numpy.arange(count)) % self.capacity
+            self.x[index] = origin[:, 0] + self.rng.random(count, dtype=numpy.float32) * origin[:, 2]
+            self.y[index] = origin[:, 1] + self.rng.random(count, dtype=numpy.float32) * origin[:, 3]
+            self.vx[index] = self.rng.uniform(-1, 1, count)
+            self.vy[index] = self.rng.uniform(-1.5, 0.25, count)
+            self.life[index] = self.rng.integers(life[0], life[1], count, endpoint=True)
+            self.color[index] = self.rng.integers(0, len(self.palette), count)
+            self.alive_count = int(numpy.count_nonzero(self.life))
+        else:
+            for r in rects:
+                for _ in range(per_rect):
+                    i = self.head
+                    self.alive_count += self.life[i] == 0
+                    self.x[i] = r.x + self.rng.random() * r.w
+                    self.y[i] = r.y + self.rng.random() * r.h
+                    self.vx[i] = self.rng.uniform(-1, 1)
+                    self.vy[i] = self.rng.uniform(-1.5, 0.25)
+                    self.life[i] = self.rng.randint(life[0], life[1])
+                    self.color[i] = self.rng.randrange(len(self.palette))
+                    self.head = (self.head + 1) % self.capacity
+            return
+        self.head = (self.head + count) % self.capacity
+
+    def update(self):
+        if self.alive_count == 0:
+            return
+        if numpy is not None:
+            # Integrating the dead slots too is cheaper than masking them out
+            self.x += self.vx
+            self.y += self.vy
+            self.vy += self.gravity
+            numpy.subtract(self.life, 1, out=self.life, where=self.life > 0)
+            self.alive_count = int(numpy.count_nonzero(self.life))
+            return
+        alive_count = 0
+        for i in range(self.capacity):
+            if self.life[i] > 0:
+                self.x[i] += self.vx[i]
+                self.y[i] += self.vy[i]
+                self.vy[i] += self.gravity
+                self.life[i] -= 1
+                alive_count += self.life[i] > 0
+        self.alive_count = alive_count
+
+    def clear(self):
+        if numpy is not None:
+            self.life.fill(0)
+        else:
+            self.life = array("h", bytes(2 * self.capacity))
+        self.alive_count = 0
+
+    def points(self, rect: Rect):
+        # World space pixel positions and palette indices of the living particles inside rect
+        if self.alive_count == 0:
+            return None
+        if numpy is not None:
+            x = self.x.astype(numpy.int32)
+            y = self.y.astype(numpy.int32)
+            mask = (self.life > 0) & (x >= rect.left) & (x < rect.right) & (y >= rect.top) & (y < rect.bottom)
+            return x[mask], y[mask], self.color[mask]
+        return [(int(self.x[i]), int(self.y[i]), self.color[i]) for i in range(self.capacity)
+                if self.life[i] > 0 and rect.collidepoint(self.x[i], self.y[i])]
+
+    def bounds(self) -> Rect:
+        if self.alive_count == 0:
+            return None
+        if numpy is not None:
+            alive = self.life > 0
+            x = self.x[alive]
+            y = self.y[alive]
+            left, top = int(x.min()), int(y.min())
+            return Rect(left, top, int(x.max()) - left + 1, int(y.max()) - top + 1)
+        points = [(int(self.x[i]), int(self.y[i])) for i in range(self.capacity) if self.life[i] > 0]
+        left = min(p[0] for p in points)
+        top = min(p[1] for p in points)
+        return Rect(left, top, max(p[0] for p in points) - left + 1, max(p[1] for p in points) - top + 1)
+
+
+class ParticleLayer(RenderingLayer):
+    def __init__(self, particles: ParticleSystem):
+        self.particles = particles
+        self.previous_bounds: Rect = None
+        # Debris is purely visual, only front ends that render turn it on
+        self.emitting = False
+
+    def on_bricks_destroyed(self, brick_grid: BrickGrid, cells):
+        if not self.emitting:
+            return
+        self.particles.emit([brick_grid.get_cell_rect(x, y) for x, y in cells])
+
+    def on_state_restored(self):
+        self.particles.clear()
+
+    def render(self, viewport: Viewport):
+        # Only the particles inside the clip are written, the pixel array ignores it
+        self.draw_points(viewport, self.particles.points(viewport.visible_rect))
+
+    @staticmethod
+    def draw_points(viewport: Viewport, points):
+        if points is None or not len(points):
+            return
+        surface = viewport.surface
+        camera = viewport.camera
+        colors = [surface.map_rgb(c) for c in ParticleSystem.palette]
+        if numpy is not None:
+            x, y, color = points
+            pixels = pygame.surfarray.pixels2d(surface)
+            pixels[x - camera.x, y - camera.y] = numpy.array(colors, dtype=pixels.dtype)[color]
+            del pixels
+            return
+        for x, y, color in points:
+            surface.fill(colors[color], (x - camera.x, y - camera.y, 1, 1))
+
+    def collect_dirty_rects(self, viewport: Viewport) -> list[Rect]:
+        bounds = self.particles.bounds()
+        dirty = [viewport.world_to_view(r) for r in (bounds, self.previous_bounds) if r is not None]
+        self.previous_bounds = bounds
+        return dirty
+
+
+class HudLayer(RenderingLayer):
+    # Drawn in view space on top of the game, labels are only laid out again when their value changes
+    def __init__(self, size: tuple[int, int]):
+        self.size = size
+        self.values = ["", "", ""]
+        self.labels: list[TextLabel] = None
+        self.dirty_rects: list[Rect] = []
+
+    def build_labels(self):
+        # On the first frame actually drawn, headless runs never rasterize the font
+        font = resources.font("freesansbold.ttf", 10)
+        atlas = GlyphAtlas.from_font(font, "0123456789 SCORELIVFP", "white")
+        width, height = self.size
+        self.labels = [TextLabel(atlas, (3, 3)), TextLabel(atlas, (width - 3, 3), "right"),
+                       TextLabel(atlas, (3, height - 3 - atlas.height))]
+        for label, text in zip(self.labels, self.values):
+            label.set_text(text)
+            self.dirty_rects.append(label.rect)
+
+    def set_values(self, score: int, lives: int, fps: float = None):
+        self.values = [f"SCORE {score}", f"LIVES {lives}", f"{fps:.0f} FPS" if fps is not None else ""]
+        if self.labels is None:
+            return
+        for label, text in zip(self.labels, self.values):
+            previous = label.rect
+            if label.set_text(text):
+                self.dirty_rects.extend((previous, label.rect))
+
+    def render(self, viewport: Viewport):
+        if self.labels is None:
+            self.build_labels()
+        for label in self.labels:
+            label.draw(viewport.surface)
+
+    def collect_dirty_rects(self, viewport: Viewport) -> list[Rect]:
+        if self.labels is None:
+            self.build_labels()
+        dirty = self.dirty_rects
+        self.dirty_rects = []
+        return dirty
+
+
+class EntityView:
+    def __init__(self, rect: Rect):
+        self.rect = Rect(rect)
+
+
+class RenderFrame:
+    # Immutable copy of everything the rendering layers read
+    def __init__(self, state: GameState, camera: Rect, fps: float = None, particles: ParticleSystem = None,
+                 grid_views: dict[int, tuple] = None):
+        self.camera = Rect(camera)
+        self.hud = (state.score, state.lives, fps)
+        self.particles = particles.points(self.camera) if particles is not None else None
+        self.paddles = [EntityView(p.rect) for p in state.paddles]
+        self.balls = [EntityView(b.rect) for b in state.balls]
+        self.powerups = [EntityView(p.rect) for p in state.powerups]
+        self.lasers = [EntityView(l.rect) for l in state.lasers]
+
+        # Grid views are kept between frames and only rebuilt for grids whose cells or geometry changed
+        if grid_views is None:
+            grid_views = {}
+        views = {}
+        for g in state.brick_grids:
+            signature = (g.revision, g.x, g.y, g.width, len(g.cells), g.environment)
+            entry = grid_views.get(id(g))
+            if entry is None or entry[0] is not g or entry[1] != signature:
+                entry = (g, signature, self.grid_view(g))
+            views[id(g)] = entry
+        grid_views.clear()
+        grid_views.update(views)
+        self.brick_grids = [views[id(g)][2] for g in state.brick_grids]
+
+    @staticmethod
+    def grid_view(grid: BrickGrid) -> BrickGrid:
+        # Alive bits only, every cell is one of the two shared Grid cells. The live bricks are not shared, so the
+        # simulation never copies them on the next hit
+        view = BrickGrid(grid.x, grid.y, grid.width, grid.cell_width, grid.cell_height, grid.environment)
+        view.cells = tuple(Grid.cell if c.alive else Grid.error_cell for c in grid.cells)
+        return view
+
+
+class RenderPipeline:
+    # Renders frame N on a worker thread while the main thread simulates frame N + 1
+    def __init__(self, viewport: Viewport, layer_factory):
+        self.viewport = Viewport(viewport.surface.get_size(), viewport.scale)
+        self.tile_layer, self.paddle_layer, self.ball_layer, self.powerups_layer, self.lasers_layer = \
+            layer_factory([], [], [], [], [])
+        self.hud_layer = HudLayer(self.viewport.surface.get_size())
+        # Grid id: grid, signature and view of the last submitted frame
+        self.grid_views: dict[int, tuple] = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending: Future = None
+
+    def render_frame(self, frame: RenderFrame) -> Surface:
+        self.viewport.camera = frame.camera
+        self.tile_layer.grids = frame.brick_grids
+        self.paddle_layer.entities = frame.paddles
+        self.ball_layer.entities = frame.balls
+        self.powerups_layer.entities = frame.powerups
+        self.lasers_layer.entities = frame.lasers
+        self.hud_layer.set_values(*frame.hud)
+
+        self.viewport.clear()
+        for l in (self.tile_layer, self.paddle_layer, self.ball_layer, self.powerups_layer, self.lasers_layer):
+            l.render(self.viewport)
+        ParticleLayer.draw_points(self.viewport, frame.particles)
+        self.hud_layer.render(self.viewport)
+        return pygame.transform.scale_by(self.viewport.surface, self.viewport.scale)
+
+    def submit(self, frame: RenderFrame):
+        self.pending = self.executor.submit(self.render_frame, frame)
+
+    def present(self, window: Surface) -> bool:
+        if self.pending is None:
+            return False
+        window.blit(self.pending.result(), window.get_rect())
+        self.pending = None
+        return True
+
+    def close(self):
+        self.executor.shutdown()
 
 
 ###############################################################################
@@ -823,31 +2548,49 @@ class PlayGameMode(GameMode, GameStateObserver):
         self.game_state = GameState()
         self.game_state.add_observer(self)
 
+        # Rendering Layers
+        self.rendering_layers = self.create_rendering_layers(self.game_state.paddles, self.game_state.balls,
+                                                             self.game_state.powerups, self.game_state.lasers,
+                                                             self.game_state.brick_grids)
+        self.viewport: Viewport = Viewport(self.game_state.area.size, 3)
+        self.previous_camera = None
+        self.particle_layer = ParticleLayer(ParticleSystem())
+        self.game_state.add_observer(self.particle_layer)
+        self.hud_layer = HudLayer(self.game_state.area.size)
+        self.rendering_layers.extend((self.particle_layer, self.hud_layer))
+
+        # Controls
+        self.paddle = self.game_state.paddle
+        self.commands: list[Command] = []
+        self.recorder: InputRecorder = None
+        self.level_streamer: LevelStreamer = None
+        self.lockstep: LockstepSession = None
+
+        #
+        self.level_clear = False
+        self.step_count = 0
+
+    @staticmethod
+    def create_rendering_layers(paddles, balls, powerups, lasers, brick_grids) -> list[RenderingLayer]:
         # Entity Layers
         paddle_layer = EntityLayer()
-        paddle_layer.entities.append(self.game_state.paddle)
+        paddle_layer.entities = paddles
 
         ball_layer = EntityLayer()
-        ball_layer.entities = self.game_state.balls
+        ball_layer.entities = balls
 
         powerups_layer = EntityLayer()
-        powerups_layer.entities = self.game_state.powerups
+        powerups_layer.entities = powerups
 
-        tile_layer = TileLayer(self.game_state.brick_grids)
+        lasers_layer = EntityLayer()
+        lasers_layer.entities = lasers
 
-        self.rendering_layers = [tile_layer, paddle_layer, ball_layer, powerups_layer]
-        self.viewport: Viewport = Viewport(self.game_state.area.size, 3)
+        tile_layer = TileLayer(brick_grids)
 
-        # Controls
-        self.paddle = self.game_state.paddle
-        self.commands: list[Command] = []
-
-        #
-        self.level_clear = False
+        return [tile_layer, paddle_layer, ball_layer, powerups_layer, lasers_layer]
 
     def process_input(self):
-        pressed_launch = False
-        move_amount = 0
+        frame_input = FrameInput()
 
         # Pygame events (close & keyboard)
         for event in pygame.event.get():
@@ -859,26 +2602,49 @@ class PlayGameMode(GameMode, GameStateObserver):
                 if event.key == pygame.K_ESCAPE:
                     self.observer.on_quit()
                     break
-                if event.key == pygame.K_p:
+                if event.key == pygame.K_p and self.lockstep is None:
                     self.observer.on_edit()
                     break
                 if event.key == pygame.K_UP:
-                    pressed_launch = True
+                    frame_input.launch = True
                     break
                 if event.key == pygame.K_DOWN:
-                    self.commands.append(ClearBallsCommand(self.game_state))
+                    frame_input.clear = True
                     break
             elif event.type == pygame.MOUSEMOTION:
                 pygame.event.set_grab(True)
             elif event.type == pygame.MOUSEBUTTONUP:
-                pressed_launch = True
+                frame_input.launch = True
 
         keys = pygame.key.get_pressed()
 
         if not pygame.event.get_grab():
-            move_amount = (-keys[pygame.K_LEFT] + keys[pygame.K_RIGHT]) * Paddle.speed
+            frame_input.move_amount = (-keys[pygame.K_LEFT] + keys[pygame.K_RIGHT]) * Paddle.speed
         else:
-            move_amount = pygame.mouse.get_rel()[0] / 3
+            frame_input.move_amount = pygame.mouse.get_rel()[0] / 3
+
+        if self.lockstep is not None:
+            self.lockstep.advance(frame_input)
+            return
+
+        self.apply_input(frame_input)
+
+    def apply_input(self, frame_input: FrameInput):
+        # The first player is fed by the caller, the others by their own input source
+        players = self.game_state.players
+        frame_inputs = [frame_input] + [p.input_source.next_input(self.game_state, p) for p in players[1:]]
+        if self.recorder is not None:
+            # Every player's input as the log stores it, so the replay simulates the same values
+            frame_inputs = [InputLog.quantize(i) for i in frame_inputs]
+            self.recorder.write(frame_inputs)
+        self.apply_frame_inputs(frame_inputs)
+
+    def apply_frame_inputs(self, frame_inputs: list[FrameInput]):
+        # One input per player, in player order
+        players = self.game_state.players
+        for player, player_input in zip(players, frame_inputs):
+            if player_input.clear:
+                self.commands.append(ClearBallsCommand(self.game_state, player))
 
         if self.level_clear:
             self.level_clear = False
@@ -888,30 +2654,38 @@ class PlayGameMode(GameMode, GameStateObserver):
             self.commands.append(LoadLevelCommand(self.game_state))
             return
 
-        # Init Ball
-        if not self.game_state.balls:
-            InitBallCommand(self.game_state).run()
+        for player, player_input in zip(players, frame_inputs):
+            # Init Ball
+            if not self.game_state.get_player_balls(player):
+                InitBallCommand(self.game_state, player).run()
 
-        # Move the Paddle
-        if move_amount != 0:
-            command = PaddleMoveCommand(self.game_state, self.paddle, move_amount)
-            self.commands.append(command)
+            # Move the Paddle
+            if player_input.move_amount != 0:
+                command = PaddleMoveCommand(self.game_state, player.paddle, player_input.move_amount)
+                self.commands.append(command)
 
-        # Launch Ball
-        if pressed_launch:
-            self.commands.append(LaunchBallCommand(self.game_state))
+            # Launch Ball
+            if player_input.launch:
+                self.commands.append(LaunchBallCommand(self.game_state, player))
 
+        # Balls, power-ups and collisions of every player are processed in a single pass
         # Move balls
         self.commands.append(MoveBallsCommand(self.game_state))
 
-        # Move PowerUps
+        # Move PowerUps and laser shots
         self.commands.append(MovePowerUpsCommand(self.game_state))
+        self.commands.append(MoveLasersCommand(self.game_state))
+
+        # Scroll and stream endless levels
+        if self.level_streamer is not None:
+            self.commands.append(StreamLevelCommand(self.level_streamer))
 
         # Process collisions
         self.commands.append(RunCollisionsCommand(self.game_state))
 
-        # Check for PowerUp contact
+        # Check for PowerUp contact and run the active effects
         self.commands.append(CheckForPowerUpCommand(self.game_state))
+        self.commands.append(UpdateEffectsCommand(self.game_state))
 
         # Apply gravity
 
@@ -925,6 +2699,16 @@ class PlayGameMode(GameMode, GameStateObserver):
         for command in self.commands:
             command.run()
         self.commands.clear()
+        self.step_count += 1
+        # The camera shows the area, endless levels scroll it through the world
+        self.viewport.move_camera(*self.game_state.area.topleft)
+
+    def update_particles(self):
+        # Once per rendered frame, outside of the simulation step
+        self.particle_layer.particles.update()
+
+    def update_hud(self, fps: float = None):
+        self.hud_layer.set_values(self.game_state.score, self.game_state.lives, fps)
 
     def render(self, window):
         self.viewport.clear()
@@ -932,11 +2716,39 @@ class PlayGameMode(GameMode, GameStateObserver):
         for l in self.rendering_layers:
             l.render(self.viewport)
 
+    def collect_dirty_rects(self) -> list[Rect]:
+        # Returns None when the whole viewport has to be redrawn
+        rects = []
+        for l in self.rendering_layers:
+            rects.extend(l.collect_dirty_rects(self.viewport))
+        camera = tuple(self.viewport.camera)
+        if camera != self.previous_camera:
+            self.previous_camera = camera
+            return None
+
+        bounds = self.viewport.surface.get_rect()
+        rects = Viewport.merge_rects([r.clip(bounds) for r in rects if r.colliderect(bounds)])
+        if sum(r.w * r.h for r in rects) > bounds.w * bounds.h // 2:
+            return None
+        return rects
+
+    def render_dirty(self, rects: list[Rect]):
+        for r in rects:
+            self.viewport.surface.set_clip(r)
+            self.viewport.clear()
+            for l in self.rendering_layers:
+                l.render(self.viewport)
+        self.viewport.surface.set_clip(None)
+
     def on_last_ball_lost(self):
-        pass
+        if self.game_state.lives <= 0:
+            self.game_state.log("Game Over")
+            self.game_state.reset_score()
 
     def on_last_brick_destroyed(self):
-        self.level_clear = True
+        # Endless levels never clear, the next chunk streams in
+        if self.level_streamer is None:
+            self.level_clear = True
 
 
 class EditorMode(GameMode, GameStateObserver):
@@ -955,9 +2767,12 @@ class EditorMode(GameMode, GameStateObserver):
 
         # Controls
         self.commands: list[Command] = []
+        self.history = CommandHistory()
 
         #
         self.hovered_brick_grid: list[BrickGrid] = []
+        self.grid_index = GridIndex()
+        self.grid_index_revision = -1
 
         # Graphical User Interface
         self.selection_rect = Rect(0, 0, 0, 0)
@@ -975,7 +2790,8 @@ class EditorMode(GameMode, GameStateObserver):
                     break
                 elif event.key == pygame.K_BACKSPACE:
                     self.commands.append(
-                        DestroyBrickCommand(self.hovered_brick_grid, self.play_game_mode.viewport.mouse))
+                        DestroyBrickCommand(self.game_state, self.hovered_brick_grid,
+                                            self.play_game_mode.viewport.mouse))
                 elif event.key == pygame.K_DELETE:
                     bg = self.hovered_brick_grid.pop()
                     self.commands.append(DestroyBrickGridCommand(self.game_state, bg))
@@ -992,11 +2808,20 @@ class EditorMode(GameMode, GameStateObserver):
                 elif event.key == pygame.K_DOWN:
                     self.commands.append(ChangeBrickGridEnvironmentCommand(self.hovered_brick_grid, -1))
                 elif event.key == pygame.K_p:
+                    self.history.clear()
                     self.observer.on_play()
                     break
                 elif event.key == pygame.K_s:
                     if event.mod & pygame.KMOD_CTRL:
                         self.commands.append(SaveLevelCommand(self.game_state))
+                elif event.key == pygame.K_z:
+                    if event.mod & pygame.KMOD_CTRL and event.mod & pygame.KMOD_SHIFT:
+                        self.commands.append(RedoCommand(self.history))
+                    elif event.mod & pygame.KMOD_CTRL:
+                        self.commands.append(UndoCommand(self.history))
+                elif event.key == pygame.K_y:
+                    if event.mod & pygame.KMOD_CTRL:
+                        self.commands.append(RedoCommand(self.history))
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 self.is_selecting = True
                 self.selection_origin = Vector2(pygame.mouse.get_pos()[0], pygame.mouse.get_pos()[1])
@@ -1006,14 +2831,16 @@ class EditorMode(GameMode, GameStateObserver):
                 new_rect.y /= 3
                 new_rect.w /= 3
                 new_rect.h /= 3
+                new_rect.move_ip(self.play_game_mode.viewport.camera.topleft)
                 # value = self.game_state.brick_grid.get_cell_world(self.selection_origin / 3)
                 self.commands.append(CreateBrickGrid(self.game_state, new_rect))
                 self.selection_rect.update(0, 0, 0, 0)
                 self.is_selecting = False
             elif event.type == pygame.MOUSEMOTION:
                 self.hovered_brick_grid.clear()
-                for bg in self.game_state.brick_grids:
-                    if bg.collide_point(self.play_game_mode.viewport.mouse):
+                mouse = self.play_game_mode.viewport.mouse
+                for bg in self.get_grid_index().query_point(mouse.x, mouse.y):
+                    if bg.collide_point(mouse):
                         self.hovered_brick_grid.append(bg)
                         break
 
@@ -1031,18 +2858,326 @@ class EditorMode(GameMode, GameStateObserver):
     def update(self):
         for command in self.commands:
             command.run()
+            if isinstance(command, UndoableCommand):
+                self.history.push(command)
+            elif isinstance(command, LoadLevelCommand):
+                self.history.clear()
         self.commands.clear()
 
+    def get_grid_index(self) -> GridIndex:
+        if self.grid_index_revision != self.game_state.brick_grids_revision:
+            self.grid_index.build(self.game_state.brick_grids)
+            self.grid_index_revision = self.game_state.brick_grids_revision
+        return self.grid_index
+
     def on_brick_grid_destroyed(self, brick_grid: BrickGrid):
         self.hovered_brick_grid.clear()
 
+    def on_state_restored(self):
+        self.hovered_brick_grid.clear()
+        self.history.clear()
+
+    def on_level_reloaded(self):
+        # Commands in the history point at grids and cells the file replaced
+        self.hovered_brick_grid.clear()
+        self.history.clear()
+
+
+###############################################################################
+#                                Telemetry                                    #
+###############################################################################
+
+class Histogram:
+    # Cumulative bucket counts in the Prometheus sense, the last bound is +Inf
+    def __init__(self, bounds: list[float]):
+        self.bounds = bounds + [float("inf")]
+        self.counts = [0] * len(self.bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def as_dict(self) -> dict:
+        buckets = {("+Inf" if b == float("inf") else repr(b)): c for b, c in zip(self.bounds, self.counts)}
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class GcPauseRecorder:
+    # One garbage collector callback times every pause and hands it to the listeners, telemetry and the tuner
+    def __init__(self):
+        self.listeners = []
+        self.start: float = None
+
+    def add_listener(self, listener):
+        if not self.listeners:
+            gc.callbacks.append(self.on_gc)
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+        if not self.listeners:
+            gc.callbacks.remove(self.on_gc)
+            self.start = None
+
+    def on_gc(self, phase: str, info: dict):
+        if phase == "start":
+            self.start = perf_counter()
+        elif self.start is not None:
+            pause = perf_counter() - self.start
+            self.start = None
+            for listener in self.listeners:
+                listener.on_gc_pause(info["generation"], pause, info["collected"])
+
+
+gc_pauses = GcPauseRecorder()
+
+
+class Telemetry:
+    # The game thread only appends samples, aggregation and writing happen on a background thread
+    frame_bounds = [0.004, 0.008, 0.0167, 0.02, 0.025, 0.0333, 0.05, 0.1, 0.25, 1.0]
+    gc_bounds = [0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1]
+    sample_interval = 60
+
+    def __init__(self, path: str, output_format: str = "prometheus", interval: float = 15.0,
+                 max_bytes: int = 8 * 1024 * 1024):
+        self.path = path
+        self.output_format = output_format
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.start_time = perf_counter()
+
+        # Filled by the game thread and the garbage collector, drained on every flush
+        self.frame_samples: deque[tuple[int, int]] = deque(maxlen=65536)
+        self.gc_samples: deque[tuple[int, float, int]] = deque(maxlen=65536)
+
+        self.frame_count = 0
+        self.steps = 0
+        self.entities: dict[str, int] = {"balls": 0, "powerups": 0, "lasers": 0, "grids": 0, "bricks": 0}
+
+        # Aggregated on the background thread only
+        self.frame_seconds = Histogram(self.frame_bounds)
+        self.frame_work_seconds = Histogram(self.frame_bounds)
+        self.gc_pause_seconds = Histogram(self.gc_bounds)
+        self.gc_collections = [0] * 3
+        self.gc_collected = 0
+
+        gc_pauses.add_listener(self)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.flush_loop, name="telemetry", daemon=True)
+        self.thread.start()
+
+    def on_gc_pause(self, generation: int, pause: float, collected: int):
+        self.gc_samples.append((generation, pause, collected))
+
+    def record_frame(self, frame_time: int, work_time: int, play_game_mode):
+        # Milliseconds as returned by Clock.tick and Clock.get_rawtime
+        self.frame_samples.append((frame_time, work_time))
+        self.frame_count += 1
+        self.steps = play_game_mode.step_count
+        if self.frame_count % self.sample_interval == 1:
+            state = play_game_mode.game_state
+            self.entities = {"balls": len(state.balls), "powerups": len(state.powerups), "lasers": len(state.lasers),
+                             "grids": len(state.brick_grids),
+                             "bricks": sum(c.alive for g in state.brick_grids for c in g.cells)}
+
+    @staticmethod
+    def resident_memory() -> int:
+        # Current RSS from procfs, peak RSS where there is no procfs
+        try:
+            with open("/proc/self/statm", mode="r") as file:
+                return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            pass
+        try:
+            import resource
+        except ImportError:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def aggregate(self) -> dict:
+        while self.frame_samples:
+            frame_time, work_time = self.frame_samples.popleft()
+            self.frame_seconds.observe(frame_time / 1000)
+            self.frame_work_seconds.observe(work_time / 1000)
+        while self.gc_samples:
+            generation, pause, collected = self.gc_samples.popleft()
+            self.gc_pause_seconds.observe(pause)
+            self.gc_collections[generation] += 1
+            self.gc_collected += collected
+        return {"time": time.time(), "uptime_seconds": perf_counter() - self.start_time,
+                "frames": self.frame_count, "simulation_steps": self.steps, "entities": dict(self.entities),
+                "resident_memory_bytes": self.resident_memory(),
+                "frame_seconds": self.frame_seconds.as_dict(), "frame_work_seconds": self.frame_work_seconds.as_dict(),
+                "gc_pause_seconds": self.gc_pause_seconds.as_dict(), "gc_collections": list(self.gc_collections),
+                "gc_collected_objects": self.gc_collected}
+
+    @staticmethod
+    def format_prometheus(metrics: dict) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: list[tuple[str, float]]):
+            lines.append(f"# HELP breakout_{name} {help_text}")
+            lines.append(f"# TYPE breakout_{name} {kind}")
+            lines.extend(f"breakout_{name}{labels} {value}" for labels, value in samples)
+
+        def histogram(name: str, help_text: str, values: dict):
+            samples = [(f'_bucket{{le="{bound}"}}', count) for bound, count in values["buckets"].items()]
+            samples += [("_sum", values["sum"]), ("_count", values["count"])]
+            metric(name, "histogram", help_text, samples)
+
+        metric("uptime_seconds", "gauge", "Seconds since telemetry started", [("", metrics["uptime_seconds"])])
+        metric("frames_total", "counter", "Presented frames", [("", metrics["frames"])])
+        metric("simulation_steps_total", "counter", "Simulated game steps, rollbacks included",
+               [("", metrics["simulation_steps"])])
+        metric("entities", "gauge", "Live entities by kind",
+               [(f'{{kind="{k}"}}', v) for k, v in metrics["entities"].items()])
+        metric("resident_memory_bytes", "gauge", "Resident set size", [("", metrics["resident_memory_bytes"])])
+        histogram("frame_seconds", "Time between presented frames", metrics["frame_seconds"])
+        histogram("frame_work_seconds", "Time spent on a frame without the frame rate wait",
+                  metrics["frame_work_seconds"])
+        histogram("gc_pause_seconds", "Garbage collection pauses", metrics["gc_pause_seconds"])
+        metric("gc_collections_total", "counter", "Garbage collections by generation",
+               [(f'{{generation="{g}"}}', c) for g, c in enumerate(metrics["gc_collections"])])
+        metric("gc_collected_objects_total", "counter", "Objects freed by the garbage collector",
+               [("", metrics["gc_collected_objects"])])
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        metrics = self.aggregate()
+        if self.output_format == "prometheus":
+            # Replaced whole so a textfile collector never reads a partial file
+            with open(self.path + ".tmp", mode="w", encoding="utf-8") as file:
+                file.write(self.format_prometheus(metrics))
+            os.replace(self.path + ".tmp", self.path)
+        else:
+            # Rotated to a single previous file, a long session keeps at most twice the cap on disk
+            line = json.dumps(metrics, separators=(",", ":")) + "\n"
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = 0
+            if size > 0 and size + len(line) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+            with open(self.path, mode="a", encoding="utf-8") as file:
+                file.write(line)
+
+    def safe_flush(self):
+        try:
+            self.flush()
+        except OSError as error:
+            print("Telemetry error:", error)
+
+    def flush_loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.safe_flush()
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        gc_pauses.remove_listener(self)
+        self.safe_flush()
+
+
+class GcTuner(GameStateObserver):
+    # Collects and freezes the heap at level transitions and pauses so collections during play only scan what
+    # gameplay allocated since, with fewer young collections. Pauses are always measured, tuned or not
+    play_thresholds = (10000, 20, 50)
+
+    def __init__(self, state: GameState, enabled: bool = False):
+        self.state = state
+        self.enabled = enabled
+        self.default_thresholds = gc.get_threshold()
+        self.paused = False
+        self.pending = False
+        self.phase = "play"
+        # Phase: collection count, total seconds, longest seconds
+        self.pauses: dict[str, list] = {}
+        gc_pauses.add_listener(self)
+        state.add_observer(self)
+
+    def on_gc_pause(self, generation: int, pause: float, collected: int):
+        stats = self.pauses.setdefault(self.phase, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += pause
+        stats[2] = max(stats[2], pause)
+
+    def collect(self, freeze: bool):
+        self.phase = "transition"
+        gc.unfreeze()
+        gc.collect()
+        if freeze:
+            gc.freeze()
+        self.phase = "paused" if self.paused else "play"
+
+    def start(self):
+        # Level already loaded by the caller
+        if self.enabled and not self.paused:
+            self.collect(True)
+            gc.set_threshold(*self.play_thresholds)
+
+    def pause(self):
+        self.paused = True
+        self.phase = "paused"
+        if self.enabled:
+            gc.set_threshold(*self.default_thresholds)
+            self.collect(False)
+
+    def resume(self):
+        self.paused = False
+        self.phase = "play"
+        self.pending = False
+        self.start()
+
+    def settle(self):
+        # Called once the commands of a frame ran, a level loaded while paused is collected but not frozen
+        if not self.pending:
+            return
+        self.pending = False
+        if self.paused:
+            if self.enabled:
+                self.collect(False)
+            return
+        self.start()
+
+    def on_level_unloaded(self):
+        # The level about to go is garbage once unloaded, it must not stay frozen
+        if self.enabled:
+            gc.unfreeze()
+
+    def on_level_loaded(self):
+        # Runs inside a command, possibly again and again during a lockstep rollback, so the collection waits
+        # for settle
+        self.pending = True
+
+    def report(self) -> str:
+        thresholds = self.play_thresholds if self.enabled else self.default_thresholds
+        lines = [f"GC tuning {'on' if self.enabled else 'off'}, play thresholds {thresholds}"]
+        for phase, (count, total, longest) in sorted(self.pauses.items()):
+            lines.append(f"  {phase}: {count} collections, {total * 1000:.2f} ms total, "
+                         f"{longest * 1000:.2f} ms longest")
+        return "\n".join(lines)
+
+    def close(self):
+        gc_pauses.remove_listener(self)
+        if self.enabled:
+            gc.set_threshold(*self.default_thresholds)
+            gc.unfreeze()
+
 
 ###############################################################################
 #                             User Interface                                  #
 ###############################################################################
 
 class UserInterface:
-    def __init__(self):
+    def __init__(self, record_path: str = None, endless_levels: list[int] = None, dirty_rendering: bool = False,
+                 pipelined: bool = False, extra_players: list[str] = None, level_pack: str = None,
+                 hot_reload: bool = False, net_address: tuple[str, int] = None, input_delay: int = 2,
+                 telemetry: Telemetry = None, gc_tuning: bool = False, gc_stats: bool = False):
         pygame.init()
 
         # Rendering properties
@@ -1050,15 +3185,49 @@ class UserInterface:
 
         # Modes
         self.play_game_mode = PlayGameMode(self)
+        self.play_game_mode.particle_layer.emitting = True
         self.editor_mode = EditorMode(self, self.play_game_mode.game_state, self.play_game_mode)
-        LoadLevelCommand(self.play_game_mode.game_state).run()
+
+        # Load assets in the background while the level and the window are set up, progress goes to the game log
+        resources.preload(image_assets, font_assets, progress=self.on_load_progress)
+
+        if level_pack is not None:
+            self.play_game_mode.game_state.level_pack = LevelPack(level_pack)
+        self.extra_players = [(kind, seed) for seed, kind in enumerate(extra_players or [])]
+        for kind, seed in self.extra_players:
+            if kind == "keyboard":
+                source = KeyboardInputSource(pygame.K_a, pygame.K_d, pygame.K_w)
+            else:
+                source = paddle_policies[kind](seed)
+            self.play_game_mode.game_state.add_player(source)
+        if endless_levels:
+            source = LevelFileChunkSource(endless_levels)
+            self.play_game_mode.level_streamer = LevelStreamer(self.play_game_mode.game_state, source)
+            self.play_game_mode.level_streamer.update()
+        else:
+            LoadLevelCommand(self.play_game_mode.game_state).run()
+
+        # Networked co-op, the two players share one game kept in lockstep through a relay
+        if net_address is not None:
+            state = self.play_game_mode.game_state
+            while len(state.players) < 2:
+                state.add_player()
+            print(f"Waiting for the other player at {net_address[0]}:{net_address[1]}")
+            self.play_game_mode.lockstep = LockstepSession(self.play_game_mode, net_address, input_delay)
+            print(f"Playing as player {self.play_game_mode.lockstep.local_index}")
+
+        # Input Recording
+        if record_path is not None:
+            level_index = self.play_game_mode.game_state.level_index
+            self.play_game_mode.recorder = InputRecorder(record_path, level_index, self.extra_players)
 
         # Window
         self.window = pygame.display.set_mode(self.play_game_mode.viewport.display_size)
+        resources.wait()
         pygame.display.set_caption("Alexandre Szybiak - Breakout")
 
-        # GUI Surface
-        self.gui_surface = Surface((self.window.get_width(), self.window.get_height()), pygame.SRCALPHA)
+        # GUI Surface, the editor grid is static and rendered once
+        self.gui_grid_surface = self.render_editor_grid()
 
         # Loop properties
         self.clock = pygame.time.Clock()
@@ -1067,67 +3236,737 @@ class UserInterface:
         # Start Mode
         self.paused = False
 
+        # Only recomposite and flip the changed regions while playing
+        self.dirty_rendering = dirty_rendering
+        self.full_redraw = True
+
+        # Render the previous frame on a worker thread while simulating the next one
+        self.render_pipeline: RenderPipeline = None
+        if pipelined:
+            self.render_pipeline = RenderPipeline(self.play_game_mode.viewport,
+                                                  PlayGameMode.create_rendering_layers)
+
+        # Apply external edits of the current level file while running, packed and endless levels have no file
+        self.level_watcher: FileWatcher = None
+        if hot_reload and level_pack is None and not endless_levels:
+            self.level_watcher = FileWatcher()
+
+        self.telemetry = telemetry
+
+        # Garbage collection around level transitions and pauses instead of during play
+        self.gc_tuner = GcTuner(self.play_game_mode.game_state, gc_tuning)
+        self.gc_tuner.start()
+        self.gc_stats = gc_stats
+
+    def render_editor_grid(self) -> Surface:
+        surface = Surface(self.window.get_size(), pygame.SRCALPHA)
+        col_count = self.play_game_mode.game_state.area.width // self.play_game_mode.game_state.brick_width
+        line_count = self.play_game_mode.game_state.area.height // self.play_game_mode.game_state.brick_height
+        col_gap = self.window.get_rect().width / col_count
+        line_gap = self.window.get_rect().height / line_count
+        col = Color(0, 255, 0, 64)
+        for x in range(col_count):
+            pygame.draw.line(surface, col, (x * col_gap, 0), (x * col_gap, self.window.get_rect().height))
+        for y in range(line_count):
+            pygame.draw.line(surface, col, (0, y * line_gap), (self.window.get_rect().width, y * line_gap))
+        return surface
+
+    def on_load_progress(self, loaded: int, total: int, path: str):
+        self.play_game_mode.game_state.log(f"Loaded {path} ({loaded}/{total})")
+
     def on_quit(self):
         self.running = False
 
     def on_edit(self):
         self.paused = True
+        self.gc_tuner.pause()
 
     def on_play(self):
         self.paused = False
+        self.full_redraw = True
+        self.gc_tuner.resume()
+
+    def check_level_file(self):
+        state = self.play_game_mode.game_state
+        self.level_watcher.watch("level_" + str(state.level_index).zfill(2) + ".json")
+        if not self.level_watcher.poll():
+            return
+        try:
+            with open(self.level_watcher.path, mode="r", encoding="utf-8") as file:
+                level = json.load(file)
+        except (OSError, ValueError) as error:
+            # A half written file is read again on its next change
+            print("Level reload error:", error)
+            return
+        ReloadLevelCommand(state, level).run()
+
+    def tick(self):
+        frame_time = self.clock.tick(60)
+        if self.telemetry is not None:
+            self.telemetry.record_frame(frame_time, self.clock.get_rawtime(), self.play_game_mode)
 
     def run(self):
-        while self.running:
-            if self.paused:
-                self.editor_mode.process_input()
-                self.editor_mode.update()
-            else:
-                self.play_game_mode.process_input()
-                self.play_game_mode.update()
-
-            self.play_game_mode.render(self.window)
-
-            # Reset window
-            self.window.fill((0, 0, 0))
-
-            # Draw Game Viewport
-            self.play_game_mode.viewport.render(self.window)
-
-            # Draw Editor Graphical User Interface
-            if self.paused:
-                self.gui_surface.fill((0, 0, 0, 0))
-
-                # Grid
-                col_count = self.play_game_mode.game_state.area.width // self.play_game_mode.game_state.brick_width
-                line_count = self.play_game_mode.game_state.area.height // self.play_game_mode.game_state.brick_height
-                col_gap = self.window.get_rect().width / col_count
-                line_gap = self.window.get_rect().height / line_count
-                col = Color(0, 255, 0, 64)
-                for x in range(col_count):
-                    pygame.draw.line(self.gui_surface, col, (x * col_gap, 0),
-                                     (x * col_gap, self.window.get_rect().height))
-                for y in range(line_count):
-                    pygame.draw.line(self.gui_surface, col, (0, y * line_gap),
-                                     (self.window.get_rect().width, y * line_gap))
-                # Selection Rectangle
-                pygame.draw.rect(self.gui_surface, "green", self.editor_mode.selection_rect, 1)
-
-                # Hovered Brick Grid
-                for bg in self.editor_mode.hovered_brick_grid:
-                    rect = bg.get_rect()
-                    rect.x *= 3
-                    rect.y *= 3
-                    rect.w *= 3
-                    rect.h *= 3
-                    pygame.draw.rect(self.gui_surface, "green", rect, 2)
-
-                self.window.blit(self.gui_surface, (0, 0))
-
-            pygame.display.update()
-            self.clock.tick(60)
-
-
-userInterface = UserInterface()
-userInterface.run()
-
-pygame.quit()
+        # Logs, worker threads, sockets and telemetry are closed even when the game loop raises
+        try:
+            while self.running:
+                if self.level_watcher is not None:
+                    self.check_level_file()
+
+                if self.paused:
+                    self.editor_mode.process_input()
+                    self.editor_mode.update()
+                else:
+                    self.play_game_mode.process_input()
+                    self.play_game_mode.update()
+                    self.play_game_mode.update_particles()
+                self.gc_tuner.settle()
+
+                self.play_game_mode.update_hud(self.clock.get_fps())
+
+                if self.render_pipeline is not None:
+                    if not self.paused:
+                        self.render_pipeline.present(self.window)
+                        self.render_pipeline.submit(RenderFrame(self.play_game_mode.game_state,
+                                                                self.play_game_mode.viewport.camera,
+                                                                self.clock.get_fps(),
+                                                                self.play_game_mode.particle_layer.particles,
+                                                                self.render_pipeline.grid_views))
+                        pygame.display.update()
+                        self.tick()
+                        continue
+                    # The editor draws synchronously, finish the frame in flight first
+                    self.render_pipeline.present(self.window)
+
+                if self.dirty_rendering:
+                    dirty_rects = self.play_game_mode.collect_dirty_rects()
+                    if not self.paused and not self.full_redraw and dirty_rects is not None:
+                        self.play_game_mode.render_dirty(dirty_rects)
+                        pygame.display.update(self.play_game_mode.viewport.render_rects(self.window, dirty_rects))
+                        self.tick()
+                        continue
+                    self.full_redraw = False
+
+                self.play_game_mode.render(self.window)
+
+                # Reset window
+                self.window.fill((0, 0, 0))
+
+                # Draw Game Viewport
+                self.play_game_mode.viewport.render(self.window)
+
+                # Draw Editor Graphical User Interface
+                if self.paused:
+                    self.window.blit(self.gui_grid_surface, (0, 0))
+
+                    # Selection Rectangle
+                    pygame.draw.rect(self.window, "green", self.editor_mode.selection_rect, 1)
+
+                    # Hovered Brick Grid
+                    for bg in self.editor_mode.hovered_brick_grid:
+                        rect = self.play_game_mode.viewport.world_to_view(bg.get_rect())
+                        rect.x *= 3
+                        rect.y *= 3
+                        rect.w *= 3
+                        rect.h *= 3
+                        pygame.draw.rect(self.window, "green", rect, 2)
+
+                pygame.display.update()
+                self.tick()
+        finally:
+            if self.play_game_mode.recorder is not None:
+                self.play_game_mode.recorder.close()
+            if self.render_pipeline is not None:
+                self.render_pipeline.close()
+            if self.level_watcher is not None:
+                self.level_watcher.close()
+            if self.play_game_mode.lockstep is not None:
+                self.play_game_mode.lockstep.close()
+            if self.telemetry is not None:
+                self.telemetry.close()
+            if self.gc_stats:
+                print(self.gc_tuner.report())
+            self.gc_tuner.close()
+
+
+class ReplayDriver:
+    def __init__(self, path: str, render: bool = False, gc_tuning: bool = False):
+        self.replay = InputReplay(path)
+        self.render = render
+        self.running = True
+
+        self.play_game_mode = PlayGameMode(self)
+        self.play_game_mode.game_state.verbose = False
+        self.play_game_mode.particle_layer.emitting = render
+        self.play_game_mode.game_state.level_index = self.replay.level_index
+        # The recorded players, their inputs come from the log
+        for _ in self.replay.players:
+            self.play_game_mode.game_state.add_player()
+        LoadLevelCommand(self.play_game_mode.game_state).run()
+        self.gc_tuner = GcTuner(self.play_game_mode.game_state, gc_tuning)
+        self.gc_tuner.start()
+
+        self.frame_count = 0
+        self.elapsed = 0.0
+
+    def on_quit(self):
+        self.running = False
+
+    def on_edit(self):
+        pass
+
+    def on_play(self):
+        pass
+
+    def run(self):
+        start = perf_counter()
+        for frame_inputs in self.replay:
+            if not self.running:
+                break
+            self.play_game_mode.apply_frame_inputs(frame_inputs)
+            self.play_game_mode.update()
+            self.gc_tuner.settle()
+            if self.render:
+                self.play_game_mode.update_particles()
+                self.play_game_mode.render(None)
+            self.frame_count += 1
+        self.elapsed = perf_counter() - start
+        self.gc_tuner.close()
+
+    @property
+    def frames_per_second(self) -> float:
+        if self.elapsed == 0:
+            return 0.0
+        return self.frame_count / self.elapsed
+
+
+###############################################################################
+#                            Level Generation                                 #
+###############################################################################
+
+class LevelGenerator:
+    patterns = ("shapes", "caves", "symmetric")
+
+    def __init__(self, seed: int, area: Rect = Rect(0, 0, 160, 240), brick_width: int = 16, brick_height: int = 8,
+                 fill_height: float = 0.6):
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.brick_width = brick_width
+        self.brick_height = brick_height
+        self.columns = area.width // brick_width
+        # Bricks stay in the upper part of the area, away from the paddle
+        self.rows = int(area.height * fill_height) // brick_height
+
+    def generate(self, pattern: str = None) -> list[dict]:
+        pattern = pattern or self.random.choice(self.patterns)
+        if pattern == "shapes":
+            mask = self.generate_shapes()
+        elif pattern == "caves":
+            mask = self.generate_caves()
+        elif pattern == "symmetric":
+            mask = self.mirror(self.generate_caves() if self.random.random() < 0.5 else self.generate_shapes())
+        else:
+            raise ValueError(f"Unknown level pattern {pattern}")
+        # The top row stays open so balls can travel above the bricks
+        mask[0] = [False] * self.columns
+        return self.to_level(mask)
+
+    def generate_into(self, state: GameState, pattern: str = None):
+        for data in self.generate(pattern):
+            state.brick_grids.append(BrickGrid.from_level_data(data, state.brick_width, state.brick_height))
+        state.invalidate_brick_grids()
+
+    # Patterns
+    def empty_mask(self) -> list[list[bool]]:
+        return [[False] * self.columns for _ in range(self.rows)]
+
+    def generate_shapes(self) -> list[list[bool]]:
+        mask = self.empty_mask()
+        for _ in range(self.random.randint(2, 6)):
+            w = self.random.randint(1, self.columns // 2)
+            h = self.random.randint(1, self.rows // 3)
+            x = self.random.randint(0, self.columns - w)
+            y = self.random.randint(1, self.rows - h)
+            diamond = self.random.random() < 0.3
+            for row in range(y, y + h):
+                for col in range(x, x + w):
+                    # Diamonds keep the cells within the inscribed rhombus
+                    if diamond and abs(col - x - (w - 1) / 2) / max(1, w / 2) + \
+                            abs(row - y - (h - 1) / 2) / max(1, h / 2) > 1:
+                        continue
+                    mask[row][col] = True
+        return mask
+
+    def generate_caves(self, scale: int = 3, threshold: float = 0.5, smoothing: int = 2) -> list[list[bool]]:
+        # Value noise on a coarse lattice, thresholded then smoothed by a cellular automaton
+        lattice = [[self.random.random() for _ in range(self.columns // scale + 2)]
+                   for _ in range(self.rows // scale + 2)]
+        mask = self.empty_mask()
+        for row in range(self.rows):
+            for col in range(self.columns):
+                ly, fy = divmod(row / scale, 1)
+                lx, fx = divmod(col / scale, 1)
+                ly, lx = int(ly), int(lx)
+                top = lattice[ly][lx] * (1 - fx) + lattice[ly][lx + 1] * fx
+                bottom = lattice[ly + 1][lx] * (1 - fx) + lattice[ly + 1][lx + 1] * fx
+                mask[row][col] = top * (1 - fy) + bottom * fy > threshold
+        for _ in range(smoothing):
+            mask = [[self.count_neighbours(mask, col, row) >= 5 or
+                     (mask[row][col] and self.count_neighbours(mask, col, row) >= 4)
+                     for col in range(self.columns)] for row in range(self.rows)]
+        return mask
+
+    def count_neighbours(self, mask: list[list[bool]], col: int, row: int) -> int:
+        count = 0
+        for y in range(row - 1, row + 2):
+            for x in range(col - 1, col + 2):
+                if (x, y) != (col, row) and 0 <= x < self.columns and 0 <= y < self.rows and mask[y][x]:
+                    count += 1
+        return count
+
+    def mirror(self, mask: list[list[bool]]) -> list[list[bool]]:
+        for row in mask:
+            for col in range(self.columns // 2):
+                row[self.columns - 1 - col] = row[col]
+        return mask
+
+    # Conversion
+    def to_level(self, mask: list[list[bool]]) -> list[dict]:
+        # Level files load every cell alive, so the mask is split into solid rectangles
+        level = []
+        used = self.empty_mask()
+        for row in range(self.rows):
+            for col in range(self.columns):
+                if not mask[row][col] or used[row][col]:
+                    continue
+                width = 1
+                while col + width < self.columns and mask[row][col + width] and not used[row][col + width]:
+                    width += 1
+                height = 1
+                while row + height < self.rows and \
+                        all(mask[row + height][c] and not used[row + height][c] for c in range(col, col + width)):
+                    height += 1
+                for y in range(row, row + height):
+                    for x in range(col, col + width):
+                        used[y][x] = True
+                level.append({"x": col * self.brick_width, "y": row * self.brick_height, "width": width,
+                              "env": self.random.randrange(BrickGrid.environment_count),
+                              "cells": [1] * (width * height)})
+        return level
+
+
+class GeneratedChunkSource(LevelChunkSource):
+    def __init__(self, seed: int):
+        self.seed = seed
+
+    def get_chunk(self, index: int) -> list[dict]:
+        return LevelGenerator(self.seed * 1000003 + index).generate()
+
+
+def generate_level_file(directory: str, level_index: int, seed: int) -> str:
+    level_name = os.path.join(directory, "level_" + str(level_index).zfill(2) + ".json")
+    with open(level_name, mode="w", encoding="utf-8") as file:
+        json.dump(LevelGenerator(seed).generate(), file, indent=4)
+    return level_name
+
+
+def generate_level_files(directory: str, first_index: int, count: int, seed: int, workers: int = None) -> list[str]:
+    workers = workers or os.cpu_count() or 1
+    indices = list(range(first_index, first_index + count))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(generate_level_file, [directory] * count, indices,
+                                 [seed * 1000003 + i for i in indices], chunksize=max(1, count // (4 * workers))))
+
+
+###############################################################################
+#                               Simulation                                    #
+###############################################################################
+
+class PaddlePolicy(InputSource):
+    def __init__(self, seed: int):
+        self.random = random.Random(seed)
+
+
+class TrackingPolicy(PaddlePolicy):
+    def __init__(self, seed: int):
+        super().__init__(seed)
+        self.aim_offset = 0
+
+    def next_input(self, state: GameState, player: Player) -> FrameInput:
+        frame_input = FrameInput()
+        balls = state.get_player_balls(player)
+        if not balls:
+            return frame_input
+        if balls[0].is_stuck_on_paddle:
+            frame_input.launch = True
+
+        # Follow the lowest falling ball, hitting it off-centre to vary the bounce angle
+        paddle = player.paddle
+        falling = [b for b in balls if b.velocity.y > 0]
+        if falling:
+            target = max(falling, key=lambda b: b.rect.bottom)
+        else:
+            target = balls[0]
+            self.aim_offset = self.random.randint(-paddle.rect.w // 2, paddle.rect.w // 2)
+        distance = target.rect.centerx - paddle.rect.centerx + self.aim_offset
+        frame_input.move_amount = max(-Paddle.speed, min(Paddle.speed, distance))
+        return frame_input
+
+
+class RandomPolicy(PaddlePolicy):
+    def next_input(self, state: GameState, player: Player) -> FrameInput:
+        frame_input = FrameInput()
+        frame_input.move_amount = self.random.choice((-Paddle.speed, 0, Paddle.speed))
+        balls = state.get_player_balls(player)
+        frame_input.launch = bool(balls) and balls[0].is_stuck_on_paddle
+        return frame_input
+
+
+class TrajectoryPredictor:
+    # Projects every ball to the paddle line, stepping all balls at once with NumPy
+    step = 3
+    max_steps = 400
+
+    def __init__(self):
+        self.occupancy = None
+        self.occupancy_signature = None
+
+    def update_occupancy(self, state: GameState):
+        signature = (tuple(state.area),) + tuple((id(g), g.x, g.y, g.width, g.revision) for g in state.brick_grids)
+        if signature == self.occupancy_signature:
+            return
+        self.occupancy_signature = signature
+
+        # One flag per pixel of the area, bricks inflated by the ball radius so the ball centre can be tested.
+        # Grids are painted whole from their alive masks on a canvas with a margin of that radius, then dilated
+        area = state.area
+        margin = 2
+        canvas = numpy.zeros((area.height + 2 * margin, area.width + 2 * margin), dtype=bool)
+        bounds = Rect(0, 0, canvas.shape[1], canvas.shape[0])
+        for g in state.brick_grids:
+            rect = Rect(g.x - area.left + margin, g.y - area.top + margin, g.width * g.cell_width,
+                        g.height * g.cell_height)
+            clipped = rect.clip(bounds)
+            if not clipped.width or not clipped.height:
+                continue
+            alive = numpy.fromiter((c.alive for c in g.cells), dtype=bool, count=len(g.cells))
+            pixels = alive.reshape(g.height, g.width).repeat(g.cell_height, axis=0).repeat(g.cell_width, axis=1)
+            canvas[clipped.top:clipped.bottom, clipped.left:clipped.right] |= pixels[
+                clipped.top - rect.top:clipped.bottom - rect.top, clipped.left - rect.left:clipped.right - rect.left]
+
+        # Square dilation, separable: rows then columns
+        dilated = canvas.copy()
+        for shift in range(1, margin + 1):
+            dilated[:, shift:] |= canvas[:, :-shift]
+            dilated[:, :-shift] |= canvas[:, shift:]
+        canvas = dilated.copy()
+        for shift in range(1, margin + 1):
+            dilated[shift:, :] |= canvas[:-shift, :]
+            dilated[:-shift, :] |= canvas[shift:, :]
+        self.occupancy = dilated[margin:margin + area.height, margin:margin + area.width]
+
+    def predict(self, state: GameState, balls: list[Ball], line_y: int) -> list[tuple[float, float]]:
+        # Returns the x position where each ball reaches the line and the number of frames it takes
+        if numpy is None:
+            return [self.predict_without_bricks(state, b, line_y) for b in balls]
+        if not balls:
+            return []
+        self.update_occupancy(state)
+
+        # In area space, the rounding stays the same wherever an endless level has scrolled the area to
+        area = state.area
+        position = numpy.array([b.rect.center for b in balls], dtype=float) - area.topleft
+        line_y -= area.top
+        velocity = numpy.array([tuple(b.velocity) for b in balls], dtype=float)
+        speed = numpy.hypot(velocity[:, 0], velocity[:, 1])
+        moving = speed > 0
+        direction = numpy.zeros_like(velocity)
+        direction[moving] = velocity[moving] / speed[moving, None]
+
+        result_x = position[:, 0].copy()
+        distance = numpy.zeros(len(balls))
+        active = moving.copy()
+        left, right, top = 2, area.width - 2, 2
+        max_x, max_y = area.width - 1, area.height - 1
+
+        for _ in range(self.max_steps):
+            if not active.any():
+                break
+            new_position = position + direction * self.step * active[:, None]
+
+            # Area walls
+            hit_x = (new_position[:, 0] < left) | (new_position[:, 0] > right)
+            hit_y = new_position[:, 1] < top
+
+            # Bricks, testing each axis separately to pick the reflection
+            cx = numpy.clip(new_position[:, 0], 0, max_x).astype(int)
+            cy = numpy.clip(new_position[:, 1], 0, max_y).astype(int)
+            ox = numpy.clip(position[:, 0], 0, max_x).astype(int)
+            oy = numpy.clip(position[:, 1], 0, max_y).astype(int)
+            inside = new_position[:, 1] >= 0
+            brick = self.occupancy[cy, cx] & inside & active
+            brick_x = brick & self.occupancy[oy, cx]
+            brick_y = brick & self.occupancy[cy, ox]
+            brick_both = brick & ~brick_x & ~brick_y
+            hit_x |= brick_x | brick_both
+            hit_y |= brick_y | brick_both
+
+            direction[hit_x, 0] *= -1
+            direction[hit_y, 1] *= -1
+            new_position[hit_x, 0] = position[hit_x, 0]
+            new_position[hit_y, 1] = position[hit_y, 1]
+            position = new_position
+            distance += self.step * active
+
+            arrived = active & (direction[:, 1] > 0) & (position[:, 1] >= line_y)
+            result_x[arrived] = position[arrived, 0]
+            active &= ~arrived
+
+        frames = numpy.full(len(balls), numpy.inf)
+        frames[moving] = distance[moving] / speed[moving]
+        # Still bouncing after max_steps, the distance covered so far is no arrival
+        frames[active] = numpy.inf
+        return list(zip((result_x + area.left).tolist(), frames.tolist()))
+
+    @staticmethod
+    def predict_without_bricks(state: GameState, ball: Ball, line_y: int) -> tuple[float, float]:
+        # Closed form with the side walls unfolded into a straight line
+        x, y = ball.rect.center
+        vx, vy = ball.velocity
+        if vy == 0:
+            return x, float("inf")
+        top = state.area.top + 2
+        dy = line_y - y if vy > 0 else (y - top) + (line_y - top)
+        frames = dy / abs(vy)
+        left = state.area.left + 2
+        width = state.area.width - 4
+        unfolded = (x + vx * frames - left) % (2 * width)
+        return left + (unfolded if unfolded <= width else 2 * width - unfolded), frames
+
+
+class PredictivePolicy(PaddlePolicy):
+    # Moves the paddle under the ball that will reach it first
+    def __init__(self, seed: int):
+        super().__init__(seed)
+        self.predictor = TrajectoryPredictor()
+        self.aim_offset = 0
+        self.frame = 0
+        # Ball id: velocity the prediction was made with, predicted x, frame of arrival
+        self.predictions: dict[int, tuple[tuple[float, float], float, float]] = {}
+
+    def next_input(self, state: GameState, player: Player) -> FrameInput:
+        frame_input = FrameInput()
+        balls = state.get_player_balls(player)
+        if not balls:
+            return frame_input
+        paddle = player.paddle
+        if balls[0].is_stuck_on_paddle:
+            frame_input.launch = True
+            self.aim_offset = self.random.randint(-paddle.rect.w // 3, paddle.rect.w // 3)
+
+        # A trajectory only changes when the ball bounces, predict again the balls whose velocity changed
+        self.frame += 1
+        flying = [b for b in balls if not b.is_stuck_on_paddle]
+        previous = self.predictions
+        self.predictions = {id(b): previous[id(b)] for b in flying
+                            if id(b) in previous and previous[id(b)][0] == tuple(b.velocity)}
+        changed = [b for b in flying if id(b) not in self.predictions]
+        for b, (x, frames) in zip(changed, self.predictor.predict(state, changed, paddle.rect.top - 2)):
+            self.predictions[id(b)] = (tuple(b.velocity), x, self.frame + frames)
+        if not self.predictions:
+            return frame_input
+        _, x, arrival = min(self.predictions.values(), key=lambda p: p[2])
+        if arrival == float("inf"):
+            return frame_input
+        distance = x - paddle.rect.centerx + self.aim_offset
+        frame_input.move_amount = max(-Paddle.speed, min(Paddle.speed, round(distance)))
+        return frame_input
+
+
+paddle_policies = {"tracking": TrackingPolicy, "random": RandomPolicy, "predictive": PredictivePolicy}
+
+
+class SessionResult:
+    def __init__(self, level_index: int, seed: int, frames: int, cleared: bool, balls_lost: int,
+                 bricks_destroyed: int):
+        self.level_index = level_index
+        self.seed = seed
+        self.frames = frames
+        self.cleared = cleared
+        self.balls_lost = balls_lost
+        self.bricks_destroyed = bricks_destroyed
+
+    @property
+    def bricks_per_second(self) -> float:
+        if self.frames == 0:
+            return 0.0
+        return self.bricks_destroyed / (self.frames / 60)
+
+
+class Simulation(GameStateObserver):
+    def __init__(self, level_index: int, policy: PaddlePolicy, max_frames: int):
+        self.policy = policy
+        self.max_frames = max_frames
+        self.running = True
+
+        self.play_game_mode = PlayGameMode(self)
+        self.game_state = self.play_game_mode.game_state
+        self.game_state.verbose = False
+        self.game_state.level_index = level_index
+        self.game_state.add_observer(self)
+        LoadLevelCommand(self.game_state).run()
+
+        self.cleared = False
+        self.balls_lost = 0
+
+    def on_quit(self):
+        self.running = False
+
+    def on_edit(self):
+        pass
+
+    def on_play(self):
+        pass
+
+    def on_ball_lost(self, ball):
+        self.balls_lost += 1
+
+    def on_last_brick_destroyed(self):
+        self.cleared = True
+
+    def count_bricks(self) -> int:
+        return sum(int(c) for g in self.game_state.brick_grids for c in g.cells)
+
+    def run(self, seed: int = 0) -> SessionResult:
+        initial_bricks = self.count_bricks()
+        frames = 0
+        while self.running and not self.cleared and frames < self.max_frames:
+            self.play_game_mode.apply_input(self.policy.next_input(self.game_state, self.game_state.players[0]))
+            self.play_game_mode.update()
+            frames += 1
+        return SessionResult(self.game_state.level_index, seed, frames, self.cleared, self.balls_lost,
+                             initial_bricks - self.count_bricks())
+
+
+def run_session(level_index: int, policy_name: str, seed: int, max_frames: int) -> SessionResult:
+    policy = paddle_policies[policy_name](seed)
+    return Simulation(level_index, policy, max_frames).run(seed)
+
+
+def run_batch(level_indices: list[int], sessions: int, policy_name: str = "tracking", max_frames: int = 36000,
+              workers: int = None) -> list[SessionResult]:
+    workers = workers or os.cpu_count() or 1
+    jobs = [(level_index, seed) for level_index in level_indices for seed in range(sessions)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(run_session,
+                               [j[0] for j in jobs],
+                               [policy_name] * len(jobs),
+                               [j[1] for j in jobs],
+                               [max_frames] * len(jobs),
+                               chunksize=max(1, len(jobs) // (4 * workers)))
+        return list(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Breakout")
+    parser.add_argument("--record", metavar="PATH", help="record play input to a binary log")
+    parser.add_argument("--replay", metavar="PATH", help="replay an input log headless at unlimited speed")
+    parser.add_argument("--render", action="store_true", help="render every replayed frame off-screen")
+    parser.add_argument("--endless", metavar="INDEX", type=int, nargs="+",
+                        help="play an endless level streamed from the given level files")
+    parser.add_argument("--dirty-rects", action="store_true", help="only redraw the changed parts of the window")
+    parser.add_argument("--pipelined", action="store_true", help="render on a worker thread, one frame behind")
+    parser.add_argument("--hot-reload", action="store_true", help="apply external edits of the level file live")
+    parser.add_argument("--relay", metavar="HOST:PORT", help="run the relay server of networked co-op")
+    parser.add_argument("--connect", metavar="HOST:PORT", help="play networked co-op through a relay")
+    parser.add_argument("--input-delay", type=int, default=2, help="frames of input delay of networked co-op")
+    parser.add_argument("--telemetry", metavar="PATH", help="periodically write frame, entity and memory metrics")
+    parser.add_argument("--telemetry-format", choices=["prometheus", "jsonl"], default="prometheus",
+                        help="Prometheus text file, replaced on each flush, or appended JSON lines")
+    parser.add_argument("--telemetry-interval", type=float, default=15.0, help="seconds between telemetry flushes")
+    parser.add_argument("--telemetry-max-bytes", type=int, default=8 * 1024 * 1024,
+                        help="size at which JSON lines telemetry is rotated to PATH.1")
+    parser.add_argument("--gc-tuning", action="store_true",
+                        help="collect and freeze the heap at level transitions and pauses, collect less during play")
+    parser.add_argument("--gc-stats", action="store_true", help="print garbage collection pauses on exit")
+    parser.add_argument("--player", dest="players", action="append", choices=["keyboard"] + sorted(paddle_policies),
+                        help="add a local player, keyboard (A/D/W) or a simulated paddle; repeatable")
+    parser.add_argument("--generate", metavar="N", type=int, help="generate N procedural level files")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated levels")
+    parser.add_argument("--first-level", type=int, default=7, help="index of the first generated level")
+    parser.add_argument("--output", default=".", help="directory of the generated levels")
+    parser.add_argument("--pack", metavar="PATH", help="load levels from a level pack")
+    parser.add_argument("--build-pack", metavar="PATH", help="pack the level files of the output directory")
+    parser.add_argument("--simulate", metavar="N", type=int, help="simulate N sessions of each level headless")
+    parser.add_argument("--levels", metavar="INDEX", type=int, nargs="+", default=[0], help="levels to simulate")
+    parser.add_argument("--policy", choices=sorted(paddle_policies), default="tracking", help="simulated paddle")
+    parser.add_argument("--max-frames", type=int, default=36000, help="frame limit of a simulated session")
+    parser.add_argument("--workers", type=int, help="number of simulation processes")
+    args = parser.parse_args()
+
+    # Networked co-op keeps exactly two players in lockstep through snapshots and the shared input pair
+    if args.connect is not None:
+        if args.record is not None:
+            parser.error("--record is not supported with --connect, the log would miss the remote inputs")
+        if args.players:
+            parser.error("--player is not supported with --connect, the two players are the networked ones")
+        if args.endless is not None:
+            parser.error("--endless is not supported with --connect, streamed levels are not part of rollbacks")
+
+    if args.build_pack is not None:
+        level_names = []
+        while os.path.exists(os.path.join(args.output, "level_" + str(len(level_names)).zfill(2) + ".json")):
+            level_names.append(os.path.join(args.output, "level_" + str(len(level_names)).zfill(2) + ".json"))
+        levels = []
+        for level_name in level_names:
+            with open(level_name, mode="r", encoding="utf-8") as file:
+                levels.append(json.load(file))
+        LevelPack.build(args.build_pack, levels)
+        print(f"Packed {len(levels)} levels into {args.build_pack}")
+        return
+
+    if args.generate is not None:
+        os.makedirs(args.output, exist_ok=True)
+        names = generate_level_files(args.output, args.first_level, args.generate, args.seed, args.workers)
+        print(f"Generated {len(names)} levels in {args.output}")
+        return
+
+    if args.simulate is not None:
+        results = run_batch(args.levels, args.simulate, args.policy, args.max_frames, args.workers)
+        for r in results:
+            print(f"level {r.level_index:02} seed {r.seed}: cleared={r.cleared} frames={r.frames} "
+                  f"balls_lost={r.balls_lost} bricks/s={r.bricks_per_second:.2f}")
+        return
+
+    if args.relay is not None:
+        relay = RelayServer(parse_address(args.relay))
+        print(f"Relay listening on {args.relay}")
+        try:
+            relay.run()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.replay is not None:
+        driver = ReplayDriver(args.replay, args.render, args.gc_tuning)
+        driver.run()
+        print(f"Replayed {driver.frame_count} frames in {driver.elapsed:.3f}s "
+              f"({driver.frames_per_second:.0f} fps)")
+        if args.gc_stats:
+            print(driver.gc_tuner.report())
+        return
+
+    net_address = parse_address(args.connect) if args.connect is not None else None
+    telemetry = None
+    if args.telemetry is not None:
+        telemetry = Telemetry(args.telemetry, args.telemetry_format, args.telemetry_interval,
+                              args.telemetry_max_bytes)
+    user_interface = UserInterface(args.record, args.endless, args.dirty_rects, args.pipelined, args.players,
+                                   args.pack, args.hot_reload, net_address, args.input_delay, telemetry,
+                                   args.gc_tuning, args.gc_stats)
+    user_interface.run()
+
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,475 @@
+import os
+import sys
+import json
+import random
+import argparse
+import importlib
+import tempfile
+
+import pygame
+from pygame import Rect
+from pygame.math import Vector2
+
+from math import copysign
+
+from breakout import (BrickGrid, GameState, GameStateSnapshot, Ball, LevelPack, Viewport, TileLayer, Command,
+                      BallCollision, BallCollisionWithPaddle, GridCollision, MoveBallsCommand, RunCollisionsCommand,
+                      BrickGridMaintenanceCommand, LoadLevelCommand, ReloadLevelCommand)
+from resources import resources
+
+
+###############################################################################
+#                                  Cases                                      #
+###############################################################################
+
+# Grids and levels are plain level data, so failing cases can be printed and loaded back as json
+
+def random_grid(rng: random.Random, max_width: int = 10, max_height: int = 10) -> dict:
+    width = rng.randint(1, max_width)
+    height = rng.randint(1, max_height)
+    density = rng.random()
+    return {"x": rng.randint(0, 6) * 16 + rng.choice((0, 0, 5)), "y": rng.randint(0, 12) * 8 + rng.choice((0, 0, 3)),
+            "width": width, "env": rng.randrange(BrickGrid.environment_count),
+            "cells": [int(rng.random() < density) for _ in range(width * height)]}
+
+
+def random_level(rng: random.Random, max_grids: int = 4) -> list[dict]:
+    return [random_grid(rng) for _ in range(rng.randint(1, max_grids))]
+
+
+def build_grid(data: dict) -> BrickGrid:
+    # Loading revives every cell, the cases still need their dead cells
+    grid = BrickGrid.from_level_data(data, 16, 8)
+    for cell, value in zip(grid.cells, data["cells"]):
+        cell.alive = bool(value)
+    return grid
+
+
+def dump_grids(grids: list[BrickGrid]) -> list[tuple]:
+    return [(g.x, g.y, g.width, g.environment, tuple(int(c) for c in g.cells)) for g in grids]
+
+
+def shrink_grid(data: dict):
+    # Smaller variants of a grid: fewer rows or columns, fewer alive cells, moved to the origin
+    width = data["width"]
+    height = len(data["cells"]) // width
+    rows = [data["cells"][i * width:(i + 1) * width] for i in range(height)]
+    if height > 1:
+        yield dict(data, cells=sum(rows[1:], []))
+        yield dict(data, cells=sum(rows[:-1], []))
+    if width > 1:
+        yield dict(data, width=width - 1, cells=sum((r[1:] for r in rows), []))
+        yield dict(data, width=width - 1, cells=sum((r[:-1] for r in rows), []))
+    if data["x"] or data["y"]:
+        yield dict(data, x=0, y=0)
+    if data["env"]:
+        yield dict(data, env=0)
+    for i, value in enumerate(data["cells"]):
+        if value:
+            yield dict(data, cells=data["cells"][:i] + [0] + data["cells"][i + 1:])
+
+
+def shrink_level(level: list[dict]):
+    for i in range(len(level)):
+        if len(level) > 1:
+            yield level[:i] + level[i + 1:]
+    for i, data in enumerate(level):
+        for smaller in shrink_grid(data):
+            yield level[:i] + [smaller] + level[i + 1:]
+
+
+###############################################################################
+#                                  Checks                                     #
+###############################################################################
+
+class HarnessError(Exception):
+    pass
+
+
+class Check:
+    # Runs a reference and a candidate implementation on the same random case. The candidate can be replaced
+    # by any callable taking a case and returning a comparable result
+    name = ""
+
+    def __init__(self):
+        self.candidate = self.run_candidate
+
+    def generate(self, rng: random.Random):
+        raise NotImplementedError()
+
+    def reference(self, case):
+        raise NotImplementedError()
+
+    def run_candidate(self, case):
+        raise NotImplementedError()
+
+    def shrink(self, case):
+        return iter(())
+
+    def fails(self, case) -> bool:
+        try:
+            expected = self.reference(case)
+        except Exception as error:
+            # A broken generator, shrinker or reference is a bug of the harness, not a mismatch
+            raise HarnessError(f"{self.name}: reference failed on {json.dumps(case)}") from error
+        try:
+            return expected != self.candidate(case)
+        except Exception:
+            # A crashing candidate is a failure, shrinking then looks for the smallest crash
+            return True
+
+    def minimize(self, case, max_steps: int = 2000):
+        # Greedy: keep the first smaller variant that still fails until none does
+        steps = 0
+        shrunk = True
+        while shrunk and steps < max_steps:
+            shrunk = False
+            for smaller in self.shrink(case):
+                steps += 1
+                if self.fails(smaller):
+                    case = smaller
+                    shrunk = True
+                    break
+        return case
+
+
+class TrimCheck(Check):
+    name = "trim"
+
+    def generate(self, rng: random.Random):
+        return random_grid(rng)
+
+    def reference(self, case):
+        # Bounding box of the alive cells, every other cell goes away
+        width = case["width"]
+        alive = [(i % width, i // width) for i, v in enumerate(case["cells"]) if v]
+        if not alive:
+            return None
+        left = min(x for x, _ in alive)
+        right = max(x for x, _ in alive)
+        top = min(y for _, y in alive)
+        bottom = max(y for _, y in alive)
+        cells = tuple(case["cells"][x + y * width] for y in range(top, bottom + 1) for x in range(left, right + 1))
+        return case["x"] + left * 16, case["y"] + top * 8, right - left + 1, cells
+
+    def run_candidate(self, case):
+        grid = build_grid(case)
+        grid.set_dirty()
+        grid.trim()
+        if not grid.cells:
+            return None
+        return grid.x, grid.y, grid.width, tuple(int(c) for c in grid.cells)
+
+    def shrink(self, case):
+        return shrink_grid(case)
+
+
+class RenderAutoTileCheck(Check):
+    # Culled, camera aware tile rendering against drawing every tile of every grid
+    name = "render_auto_tile"
+
+    def generate(self, rng: random.Random):
+        camera = [rng.randint(-40, 80), rng.randint(-40, 80)]
+        clip = None
+        if rng.random() < 0.5:
+            clip = [rng.randint(0, 100), rng.randint(0, 150), rng.randint(1, 80), rng.randint(1, 100)]
+        return {"level": random_level(rng), "camera": camera, "clip": clip}
+
+    @staticmethod
+    def viewport(case) -> Viewport:
+        viewport = Viewport((160, 240), 1)
+        viewport.camera.topleft = case["camera"]
+        viewport.clear()
+        if case["clip"] is not None:
+            viewport.surface.set_clip(Rect(case["clip"]))
+        return viewport
+
+    def reference(self, case):
+        viewport = self.viewport(case)
+        tile_set = resources.image(TileLayer([]).tile_set_files[0], (0, 0, 0))
+        camera = viewport.camera
+        for g in [build_grid(d) for d in case["level"]]:
+            for x in range(-1, g.width):
+                for y in range(-1, g.height):
+                    value = int(g.is_cell_alive(x, y))
+                    value += int(g.is_cell_alive(x + 1, y)) * 2
+                    value += int(g.is_cell_alive(x, y + 1)) * 4
+                    value += int(g.is_cell_alive(x + 1, y + 1)) * 8
+                    if value == 0:
+                        continue
+                    dest = Rect(x * g.cell_width + g.x + (g.cell_width / 2) - camera.x,
+                                y * g.cell_height + g.y + (g.cell_height / 2) - camera.y,
+                                g.cell_width, g.cell_height)
+                    area = Rect((value - 1) * g.cell_width, g.environment * g.cell_height, g.cell_width,
+                                g.cell_height)
+                    viewport.surface.blit(tile_set, dest, area)
+        return pygame.image.tobytes(viewport.surface, "RGB")
+
+    def run_candidate(self, case):
+        viewport = self.viewport(case)
+        TileLayer([build_grid(d) for d in case["level"]]).render(viewport)
+        return pygame.image.tobytes(viewport.surface, "RGB")
+
+    def shrink(self, case):
+        for level in shrink_level(case["level"]):
+            yield dict(case, level=level)
+        if case["clip"] is not None:
+            yield dict(case, clip=None)
+        if case["camera"] != [0, 0]:
+            yield dict(case, camera=[0, 0])
+
+
+class LevelLoadingCheck(Check):
+    # Loading the level data directly against reading it from a level pack and hot-reloading it over another level
+    # with bricks destroyed in play
+    name = "level_loading"
+
+    def generate(self, rng: random.Random):
+        previous = random_level(rng)
+        # Mostly the same grids so the reload patches them, some reshaped, dropped or added
+        level = [d if rng.random() < 0.6 else random_grid(rng) for d in previous if rng.random() < 0.9]
+        level += [random_grid(rng) for _ in range(rng.randint(0, 1))] if level else [random_grid(rng)]
+        kills = [[i, j] for i, d in enumerate(previous) for j in range(len(d["cells"])) if rng.random() < 0.3]
+        return {"previous": previous, "level": level, "kills": kills}
+
+    def reference(self, case):
+        # The pack gives back the level data as written, every cell of it loads alive
+        grids = [(d["x"], d["y"], d["width"], d["env"], (1,) * len(d["cells"])) for d in case["level"]]
+        return grids, case["level"]
+
+    def run_candidate(self, case):
+        path = os.path.join(tempfile.mkdtemp(), "levels.bkpk")
+        try:
+            LevelPack.build(path, [case["previous"], case["level"]])
+            state = GameState()
+            state.verbose = False
+            state.level_pack = LevelPack(path)
+            LoadLevelCommand(state).run()
+            for i, j in case["kills"]:
+                if i < len(state.brick_grids) and j < len(state.brick_grids[i].cells):
+                    g = state.brick_grids[i]
+                    g.kill_cell(j % g.width, j // g.width)
+            level = LevelPack(path).get_level(1)
+            ReloadLevelCommand(state, level).run()
+        finally:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+        return dump_grids(state.brick_grids), level
+
+    def shrink(self, case):
+        for i in range(len(case["kills"])):
+            yield dict(case, kills=case["kills"][:i] + case["kills"][i + 1:])
+        for level in shrink_level(case["level"]):
+            yield dict(case, level=level)
+        for previous in shrink_level(case["previous"]):
+            yield dict(case, previous=previous)
+
+
+class ReferenceMoveBallsCommand(Command):
+    # Frozen copy of MoveBallsCommand, the oracle optimized versions of it are checked against
+    def __init__(self, state):
+        self.state: GameState = state
+
+    def run(self):
+        for b in self.state.balls:
+            if b.is_stuck_on_paddle:
+                b.rect.midbottom = b.owner.paddle.rect.midtop
+                continue
+            self.move_y(b)
+            self.move_x(b)
+            if not self.state.area.colliderect(b.rect):
+                self.state.notify_ball_lost(b)
+                self.state.balls.remove(b)
+                if not self.state.get_player_balls(b.owner):
+                    self.state.lives -= 1
+                    self.state.notify_last_ball_lost()
+
+    def collide_grids(self, ball, axis: Vector2, x1: int, y1: int, x2: int, y2: int) -> bool:
+        collide = False
+        for g in self.state.brick_grids:
+            cell_1 = g.get_cell_coordinates(x1, y1)
+            cell_2 = g.get_cell_coordinates(x2, y2)
+            cells = g.get_region_coordinate_and_cells(cell_1[0], cell_1[1], cell_2[0], cell_2[1])
+            hit_cells = [c for c in cells if c[2].alive]
+            if hit_cells:
+                self.state.collisions.append(GridCollision(self.state, ball, axis, g, hit_cells))
+                collide = True
+        if collide:
+            self.state.collisions.append(BallCollision(self.state, ball, axis))
+        return collide
+
+    def collide_x(self, ball: Ball, x_direction) -> bool:
+        axis = Vector2(1, 0)
+        next_rect = ball.rect.move(x_direction, 0)
+        if next_rect.collidelist(self.state.paddles) != -1 or not self.state.area.contains(next_rect):
+            self.state.collisions.append(BallCollision(self.state, ball, axis))
+            return True
+        x = next_rect.left if x_direction < 0 else next_rect.right
+        return self.collide_grids(ball, axis, x, next_rect.top, x, next_rect.bottom)
+
+    def collide_y(self, ball: Ball, y_direction) -> bool:
+        axis = Vector2(0, 1)
+        ball_rect = ball.rect.move(0, y_direction)
+        paddle_index = ball_rect.collidelist(self.state.paddles)
+        if paddle_index != -1:
+            paddle = self.state.paddles[paddle_index]
+            self.state.collisions.append(BallCollisionWithPaddle(self.state, ball, axis, paddle))
+            return True
+        if ball_rect.top < self.state.area.top:
+            self.state.collisions.append(BallCollision(self.state, ball, axis))
+            return True
+        y = ball_rect.top if y_direction < 0 else ball_rect.bottom
+        return self.collide_grids(ball, axis, ball_rect.left, y, ball_rect.right, y)
+
+    def move(self, ball: Ball, index: int, collide):
+        ball.movement_remainder[index] += ball.velocity[index] * self.state.ball_speed_scale
+        move = round(ball.movement_remainder[index])
+        if move == 0:
+            return
+        ball.movement_remainder[index] -= move
+        sign = int(copysign(1, move))
+        offset = [0, 0]
+        offset[index] = sign
+        while move != 0:
+            move -= sign
+            if collide(ball, sign):
+                break
+            ball.rect.move_ip(offset)
+
+    def move_x(self, ball: Ball):
+        self.move(ball, 0, self.collide_x)
+
+    def move_y(self, ball: Ball):
+        self.move(ball, 1, self.collide_y)
+
+
+class MoveBallsCheck(Check):
+    # Ball movement and brick collisions against the frozen reference, the candidate runs the current command on a
+    # state restored from a json snapshot
+    name = "move_balls"
+    candidate_command = MoveBallsCommand
+
+    def generate(self, rng: random.Random):
+        balls = []
+        for _ in range(rng.randint(1, 6)):
+            speed = rng.choice((1, 1, 1.5, 2))
+            balls.append([rng.randint(4, 150), rng.randint(4, 230), rng.choice((-1, 1)) * speed * rng.random(),
+                          rng.choice((-1, 1)) * speed])
+        return {"level": random_level(rng), "balls": balls, "frames": rng.randint(1, 400)}
+
+    @staticmethod
+    def build_state(case) -> GameState:
+        state = GameState()
+        state.verbose = False
+        state.brick_grids.extend(build_grid(d) for d in case["level"])
+        for x, y, vx, vy in case["balls"]:
+            ball = Ball(Vector2(x, y))
+            ball.velocity = Vector2(vx, vy)
+            ball.owner = state.players[0]
+            state.balls.append(ball)
+        return state
+
+    @staticmethod
+    def simulate(state: GameState, frames: int, move_balls) -> tuple:
+        for _ in range(frames):
+            move_balls(state).run()
+            RunCollisionsCommand(state).run()
+            BrickGridMaintenanceCommand(state).run()
+        alive = {(g.x + i % g.width * g.cell_width, g.y + i // g.width * g.cell_height)
+                 for g in state.brick_grids for i, c in enumerate(g.cells) if c.alive}
+        balls = [(tuple(b.rect), tuple(b.velocity)) for b in state.balls]
+        return balls, sorted(alive), state.score
+
+    def reference(self, case):
+        return self.simulate(self.build_state(case), case["frames"], ReferenceMoveBallsCommand)
+
+    def run_candidate(self, case):
+        data = json.loads(json.dumps(self.build_state(case).snapshot().as_dict()))
+        state = GameState()
+        state.verbose = False
+        state.restore(GameStateSnapshot.from_dict(data))
+        return self.simulate(state, case["frames"], self.candidate_command)
+
+    def shrink(self, case):
+        if case["frames"] > 1:
+            yield dict(case, frames=case["frames"] // 2)
+            yield dict(case, frames=case["frames"] - 1)
+        for i in range(len(case["balls"])):
+            if len(case["balls"]) > 1:
+                yield dict(case, balls=case["balls"][:i] + case["balls"][i + 1:])
+        for level in shrink_level(case["level"]):
+            yield dict(case, level=level)
+
+
+checks: dict[str, Check] = {c.name: c for c in (TrimCheck(), RenderAutoTileCheck(), LevelLoadingCheck(),
+                                                 MoveBallsCheck())}
+
+
+###############################################################################
+#                                  Runner                                     #
+###############################################################################
+
+def run_check(check: Check, case_count: int, seed: int):
+    # Returns the minimal failing case, or None when every case agreed
+    rng = random.Random(seed)
+    for _ in range(case_count):
+        case = check.generate(rng)
+        if check.fails(case):
+            return check.minimize(case)
+    return None
+
+
+def import_attribute(target: str):
+    # module:attribute
+    module_name, _, attribute = target.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def load_candidate(text: str):
+    # NAME=module:attribute
+    name, _, target = text.partition("=")
+    return name, import_attribute(target)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare optimized engine paths against reference implementations")
+    parser.add_argument("--checks", nargs="+", choices=sorted(checks), default=sorted(checks), help="checks to run")
+    parser.add_argument("--cases", type=int, default=200, help="random cases per check")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the case generator")
+    parser.add_argument("--candidate", action="append", default=[], metavar="NAME=MODULE:CALLABLE",
+                        help="replace the candidate of a check with a callable taking a case")
+    parser.add_argument("--move-balls-command", metavar="MODULE:CLASS",
+                        help="command class run by the move_balls candidate in place of MoveBallsCommand")
+    parser.add_argument("--output", metavar="DIRECTORY", help="write minimal failing cases as json files")
+    args = parser.parse_args()
+
+    if args.move_balls_command is not None:
+        checks["move_balls"].candidate_command = import_attribute(args.move_balls_command)
+
+    for text in args.candidate:
+        name, candidate = load_candidate(text)
+        checks[name].candidate = candidate
+
+    failures = 0
+    for name in args.checks:
+        try:
+            case = run_check(checks[name], args.cases, args.seed)
+        except HarnessError as error:
+            print(f"{name}: HARNESS ERROR, {error}: {error.__cause__!r}")
+            sys.exit(2)
+        if case is None:
+            print(f"{name}: {args.cases} cases agree")
+            continue
+        failures += 1
+        print(f"{name}: FAILED, minimal case:")
+        print(json.dumps(case))
+        if args.output is not None:
+            os.makedirs(args.output, exist_ok=True)
+            with open(os.path.join(args.output, name + ".json"), mode="w", encoding="utf-8") as file:
+                json.dump(case, file, indent=4)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
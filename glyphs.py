@@ -0,0 +1,78 @@
+import pygame
+from pygame import Rect
+from pygame.surface import Surface
+
+
+class GlyphAtlas:
+    # Every glyph rasterized once into a single surface, text is drawn by blitting areas of it
+    def __init__(self, surface: Surface, glyphs: dict[str, Rect], spacing: int = 0):
+        self.surface = surface
+        self.glyphs = glyphs
+        self.spacing = spacing
+        self.height = max((r.height for r in glyphs.values()), default=0)
+
+    @classmethod
+    def from_font(cls, font: pygame.font.Font, characters: str, color, background=None, spacing: int = 0):
+        images = [font.render(c, False, color, background) for c in characters]
+        surface = Surface((sum(i.get_width() for i in images), max(i.get_height() for i in images)),
+                          0 if background is not None else pygame.SRCALPHA)
+        glyphs = {}
+        x = 0
+        for c, image in zip(characters, images):
+            glyphs[c] = Rect(x, 0, image.get_width(), image.get_height())
+            surface.blit(image, (x, 0))
+            x += image.get_width()
+        return cls(surface, glyphs, spacing)
+
+    @classmethod
+    def from_strip(cls, surface: Surface, characters: str, glyph_size: tuple[int, int], spacing: int = 0):
+        # Sprite sheet with the glyphs side by side, e.g. the digits of numbers.bmp
+        w, h = glyph_size
+        glyphs = {c: Rect(i * w, 0, w, h) for i, c in enumerate(characters)}
+        return cls(surface, glyphs, spacing)
+
+    def measure(self, text: str) -> int:
+        widths = [self.glyphs[c].width for c in text if c in self.glyphs]
+        return sum(widths) + self.spacing * max(len(widths) - 1, 0)
+
+    def layout(self, text: str, x: int, y: int) -> list[tuple[Surface, tuple[int, int], Rect]]:
+        # Blit sequence for Surface.blits, characters missing from the atlas are skipped
+        sequence = []
+        for c in text:
+            area = self.glyphs.get(c)
+            if area is None:
+                continue
+            sequence.append((self.surface, (x, y), area))
+            x += area.width + self.spacing
+        return sequence
+
+
+class TextLabel:
+    # The blit sequence is only laid out again when the text changes
+    def __init__(self, atlas: GlyphAtlas, position: tuple[int, int], align: str = "left"):
+        self.atlas = atlas
+        self.position = position
+        self.align = align
+        self.text: str = None
+        self.sequence: list = []
+        self.rect = Rect(position, (0, 0))
+
+    def set_text(self, text: str) -> bool:
+        if text == self.text:
+            return False
+        self.text = text
+        width = self.atlas.measure(text)
+        x, y = self.position
+        if self.align == "right":
+            x -= width
+        elif self.align == "center":
+            x -= width // 2
+        self.rect = Rect(x, y, width, self.atlas.height)
+        self.sequence = self.atlas.layout(text, x, y)
+        return True
+
+    def set_value(self, value) -> bool:
+        return self.set_text(str(value))
+
+    def draw(self, surface: Surface):
+        surface.blits(self.sequence, doreturn=False)
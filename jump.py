@@ -1,16 +1,19 @@
 # Example file showing a basic pygame "game loop"
+import argparse
 import random
-import math
-from math import copysign, floor
-from operator import truediv
-from random import randint
-from tokenize import Intnumber
+from bisect import bisect_left, bisect_right
+from math import copysign
+from time import perf_counter
 
 import pygame
 
+from glyphs import GlyphAtlas, TextLabel
+from resources import resources
+
 # param
 resolution = (160,240)
 pixel_size = 3
+fps = 60
 
 # game param
 gravity = 0.065
@@ -21,36 +24,73 @@ smallest_platform = 16
 largest_platform = 48
 platform_height = 4
 player_spawn_position = 48
-platform_timer_id = 999
 score_position = (3,3)
 
 class Laser:
-    def __init__(self, y):
-        self.rect = pygame.Rect(0, y, viewport.get_width(), laser_height)
-    def draw(self):
-        pygame.draw.rect(viewport, 'red', self.rect)
+    def __init__(self, y, width):
+        self.rect = pygame.Rect(0, y, width, laser_height)
+    def draw(self, surface):
+        pygame.draw.rect(surface, 'red', self.rect)
 class Platform:
+    def __init__(self, rng, width, height):
+        _width = rng.randint(smallest_platform, largest_platform)
+        _x = rng.randint(0, width - _width)
+        self.rect = pygame.Rect(_x, height + rng.randint(0, 32), _width, platform_height)
+    def draw(self, surface, scroll):
+        pygame.draw.rect(surface, 'blue', self.rect.move(0, -scroll))
+class PlatformField:
+    # Platforms all rise together: they keep a fixed world position sorted by y and the field scrolls
     def __init__(self):
-        _width = random.randint(smallest_platform, largest_platform)
-        _x = random.randint(0, viewport.get_width() - _width)
-        _y = viewport.get_height()
-        self.rect = pygame.Rect(_x, _y, _width, platform_height)
-        self.rect.move_ip(0, randint(0, 32))
+        self.scroll = 0
+        self.tops = []
+        self.platforms = []
+    def __len__(self):
+        return len(self.platforms)
+    def __iter__(self):
+        return iter(self.platforms)
+    def append(self, platform):
+        platform.rect.move_ip(0, self.scroll)
+        index = bisect_right(self.tops, platform.rect.top)
+        self.tops.insert(index, platform.rect.top)
+        self.platforms.insert(index, platform)
+    def remove(self, platform):
+        index = self.platforms.index(platform)
+        del self.tops[index]
+        del self.platforms[index]
+    def clear(self):
+        self.tops.clear()
+        self.platforms.clear()
     def update(self):
-        self.rect.move_ip(0, -1)
-        #self.rect.update((self.rect.x, self.rect.y - 1), (self.rect.w, self.rect.h))
-    def draw(self):
-        pygame.draw.rect(viewport, 'blue', self.rect)
+        self.scroll += 1
+        # Platforms leaving the top of the screen are always at the front
+        count = bisect_left(self.tops, self.scroll - platform_height)
+        del self.tops[:count]
+        del self.platforms[:count]
+    def collide(self, rect):
+        # Only the platforms whose top lies in the vertical band of the rect
+        world_rect = rect.move(0, self.scroll)
+        start = bisect_left(self.tops, world_rect.top - platform_height + 1)
+        end = bisect_left(self.tops, world_rect.bottom)
+        for p in self.platforms[start:end]:
+            if world_rect.colliderect(p.rect):
+                return p
+        return None
+    def draw(self, surface):
+        start = bisect_left(self.tops, self.scroll - platform_height + 1)
+        end = bisect_left(self.tops, self.scroll + surface.get_height())
+        for p in self.platforms[start:end]:
+            p.draw(surface, self.scroll)
 
 class Player:
-    def __init__(self):
+    def __init__(self, game):
+        self.game = game
         self.alive = True
         self.is_falling = False
         self._width = 8
         self._height = 24
         self._velocity_y = 0
         self._y_remainder = 0
-        self.rect = pygame.Rect(viewport.get_width()/2-5, player_spawn_position, self._width, self._height)
+        self.rect = pygame.Rect(game.width/2-5, player_spawn_position, self._width, self._height)
         self.bounce_amount = 3.2
         self.bounce_amount_modifier = 0.25
         self.score = 0
@@ -70,32 +110,29 @@ class Player:
         self.alive = True
         self.score = 0
         self.rect.y = player_spawn_position
-        self.rect.centerx = viewport.get_rect().centerx
+        self.rect.centerx = self.game.width // 2
         self._velocity_y = 0
     def die(self):
         self.alive = False
         self.is_falling = False
-        pygame.time.set_timer(platform_timer_id, 0, 0)
-        platforms.clear()
-    def update(self):
+        self.game.stop_spawning()
+        self.game.platforms.clear()
+    def update(self, move_dir):
         if not self.alive:
             return
-        move_dir = -keys[pygame.K_LEFT] + keys[pygame.K_RIGHT]
         if not self.is_falling:
             return
         # Check for death
-        if self.rect.collidelist(lasers) != -1:
+        if self.rect.collidelist(self.game.lasers) != -1:
             self.die()
         self._velocity_y += gravity
         if self._velocity_y > 4:
             self._velocity_y = 4
-        #self._velocity_y
-        #self._y += self._velocity_y
         self.rect.move_ip(move_dir * 2, 0)
         if self.rect.left < 0:
             self.rect.left = 0
-        elif self.rect.right > viewport.get_width():
-            self.rect.right = viewport.get_width()
+        elif self.rect.right > self.game.width:
+            self.rect.right = self.game.width
         self.move_y(self._velocity_y)
     def move_y(self, amount):
         self._y_remainder += amount
@@ -104,93 +141,163 @@ class Player:
             return
         self._y_remainder -= _move
         _sign = copysign(1, _move)
+        platforms = self.game.platforms
         while _move != 0:
-            p = self.rect.move(0,_sign).collidelist(platforms)
-            if p == -1:
+            p = platforms.collide(self.rect.move(0,_sign))
+            if p is None:
                 self.rect.move_ip(0, _sign)
                 _move -= _sign
             else:
                 self._velocity_y = -self.bounce_amount * (1 - self.flip * self.bounce_amount_modifier)
                 self.set_flip(not self.flip)
-                platforms.pop(p)
+                platforms.remove(p)
                 self.score += 1
                 break
-    def draw(self):
+    def draw(self, surface):
         if self.alive:
-            pygame.draw.rect(viewport, 'yellow',self.rect)
-
-# pygame setup
-pygame.init()
-screen = pygame.display.set_mode((resolution[0] * pixel_size, resolution[1] * pixel_size))
-viewport = pygame.Surface(resolution)
-clock = pygame.time.Clock()
-pygame.time.set_timer(platform_timer_id, platform_timer, 0)
-running = True
-keys = pygame.key.get_pressed()
-font = pygame.font.Font('freesansbold.ttf', 32)
-game_over_text = font.render('Game Over', False, 'green', 'blue')
-game_over_text_rect = game_over_text.get_rect()
-
-#game variable
-game_state = 0
-
-#ingame variables
-numbers_sprite = pygame.image.load('numbers.bmp')
-numbers_sprite.set_colorkey((255,0,255))
-platforms = []
-lasers = [ Laser(laser_position), Laser(viewport.get_height() - laser_position - laser_height) ]
-player = Player()
-
-while running:
-    # poll for events
-    # pygame.QUIT event means the user clicked X to close your window
-    for event in pygame.event.get():
-        if event.type == pygame.KEYDOWN:
-            if not player.alive:
-                player.respawn()
-                pygame.time.set_timer(platform_timer_id, platform_timer, 0)
-            elif not player.is_falling:
-                player.is_falling = True
-        if event.type == pygame.QUIT:
-            running = False
-        if event.type == 999:
-            p = Platform()
-            platforms.append(p)
-    keys = pygame.key.get_pressed()
-
-    # fill the screen with a color to wipe away anything from last frame
-    viewport.fill(0x656565)
-
-    # UPDATE GAME
-    player.update()
-    for p in platforms:
-        p.update()
-        if p.rect[1] < 0 - platform_height:
-            platforms.remove(p)
-
-    # RENDER YOUR GAME HERE
-    #viewport.blit(wall, wall.get_rect())
-    player.draw()
-    for p in platforms:
-        p.draw()
-    # Laser
-    pygame.draw.rect(viewport, 'red', (0, laser_position, viewport.get_width(), laser_height))
-    pygame.draw.rect(viewport, 'red', (0, viewport.get_height() - laser_position, viewport.get_width(), laser_height))
-
-    if not player.alive:
-        viewport.blit(game_over_text, game_over_text_rect)
-
-    # Display score
-    n = floor(player.score / 10)
-    if n > 0:
-        viewport.blit(numbers_sprite, (viewport.get_width() - 10,3,5,5),(n * 5,0,5,5))
-    n = player.score % 10
-    viewport.blit(numbers_sprite, (viewport.get_width() - 6,3,5,5),(n * 5,0,5,5))
-    # flip() the display to put your work on screen
-    screen.blit(pygame.transform.scale_by(viewport, 3), screen.get_rect())
-
-    pygame.display.flip()
-
-    clock.tick(60)  # limits FPS to 60
-
-pygame.quit()
+            pygame.draw.rect(surface, 'yellow',self.rect)
+
+class JumpGame:
+    # The whole game, stepped one frame at a time so it runs the same with or without a window
+    def __init__(self, seed=None, size=resolution):
+        self.width, self.height = size
+        self.rng = random.Random(seed)
+        self.frame = 0
+        # Platforms spawn on simulated time, counted in frames instead of a wall clock timer
+        self.spawn_interval = platform_timer * fps // 1000
+        self.next_spawn = self.spawn_interval
+        self.deaths = 0
+        self.best_score = 0
+        self.platforms = PlatformField()
+        self.lasers = [ Laser(laser_position, self.width), Laser(self.height - laser_position - laser_height, self.width) ]
+        self.player = Player(self)
+    def stop_spawning(self):
+        self.next_spawn = None
+        self.deaths += 1
+        self.best_score = max(self.best_score, self.player.score)
+    def press(self):
+        # Any key: respawns after a game over, otherwise drops the player
+        if not self.player.alive:
+            self.player.respawn()
+            self.next_spawn = self.frame + self.spawn_interval
+        elif not self.player.is_falling:
+            self.player.is_falling = True
+    def step(self, move_dir, pressed=False):
+        if pressed:
+            self.press()
+        if self.next_spawn is not None and self.frame >= self.next_spawn:
+            self.platforms.append(Platform(self.rng, self.width, self.height))
+            self.next_spawn += self.spawn_interval
+        self.player.update(move_dir)
+        self.platforms.update()
+        self.frame += 1
+    def draw(self, surface):
+        self.player.draw(surface)
+        self.platforms.draw(surface)
+        for laser in self.lasers:
+            laser.draw(surface)
+
+class AutoPlayer:
+    # Keeps pressing and steers toward the next platform below, used to drive the headless mode
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+    def next_input(self, game):
+        player = game.player
+        if not player.alive:
+            return 0, True
+        target = game.platforms.collide(pygame.Rect(0, player.rect.bottom, game.width, game.height))
+        if not player.is_falling:
+            return 0, target is not None
+        if target is None:
+            return self.rng.choice((-1, 0, 1)), False
+        x = target.rect.centerx
+        if abs(x - player.rect.centerx) < 2:
+            return 0, False
+        return (1 if x > player.rect.centerx else -1), False
+
+def run_headless(frames, seed=None, policy=None):
+    # Fast-forwards the game without a display or frame limiter
+    game = JumpGame(seed)
+    policy = policy or AutoPlayer(seed)
+    for _ in range(frames):
+        move_dir, pressed = policy.next_input(game)
+        game.step(move_dir, pressed)
+    if game.player.alive:
+        game.best_score = max(game.best_score, game.player.score)
+    return game
+
+def play(seed=None):
+    # pygame setup
+    pygame.init()
+    resources.preload([('numbers.bmp', (255, 0, 255))], [('freesansbold.ttf', 32), ('freesansbold.ttf', 10)])
+    screen = pygame.display.set_mode((resolution[0] * pixel_size, resolution[1] * pixel_size))
+    viewport = pygame.Surface(resolution)
+    clock = pygame.time.Clock()
+    running = True
+    resources.wait()
+    font = resources.font('freesansbold.ttf', 32)
+    game_over_text = font.render('Game Over', False, 'green', 'blue')
+    game_over_text_rect = game_over_text.get_rect()
+    # Digits of numbers.bmp are 4 pixels wide in 5 pixel cells
+    numbers = GlyphAtlas.from_strip(resources.image('numbers.bmp', (255, 0, 255)), '0123456789', (5, 5), -1)
+    score_label = TextLabel(numbers, (resolution[0] - 1, 3), 'right')
+    fps_label = TextLabel(GlyphAtlas.from_font(resources.font('freesansbold.ttf', 10), '0123456789 FPS', 'white'),
+                          (3, resolution[1] - 13))
+
+    game = JumpGame(seed)
+
+    while running:
+        # poll for events
+        # pygame.QUIT event means the user clicked X to close your window
+        pressed = False
+        for event in pygame.event.get():
+            if event.type == pygame.KEYDOWN:
+                pressed = True
+            if event.type == pygame.QUIT:
+                running = False
+        keys = pygame.key.get_pressed()
+
+        # UPDATE GAME
+        game.step(-keys[pygame.K_LEFT] + keys[pygame.K_RIGHT], pressed)
+
+        # fill the screen with a color to wipe away anything from last frame
+        viewport.fill(0x656565)
+
+        # RENDER YOUR GAME HERE
+        game.draw(viewport)
+
+        if not game.player.alive:
+            viewport.blit(game_over_text, game_over_text_rect)
+
+        # Display score and frame rate, labels are only laid out again when the value changes
+        score_label.set_value(game.player.score)
+        score_label.draw(viewport)
+        fps_label.set_text(f'{clock.get_fps():.0f} FPS')
+        fps_label.draw(viewport)
+        # flip() the display to put your work on screen
+        screen.blit(pygame.transform.scale_by(viewport, pixel_size), screen.get_rect())
+
+        pygame.display.flip()
+
+        clock.tick(fps)  # limits FPS to 60
+
+    pygame.quit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Jump")
+    parser.add_argument("--headless", type=int, metavar="FRAMES", help="fast-forward FRAMES frames without a window")
+    parser.add_argument("--seed", type=int, help="seed for the platform spawner")
+    args = parser.parse_args()
+
+    if args.headless is None:
+        play(args.seed)
+        return
+
+    start = perf_counter()
+    game = run_headless(args.headless, args.seed)
+    elapsed = perf_counter() - start
+    print(f"frames={game.frame} deaths={game.deaths} best_score={game.best_score} "
+          f"elapsed={elapsed:.3f}s ({game.frame / max(elapsed, 1e-9):.0f} frames/s)")
+
+if __name__ == "__main__":
+    main()
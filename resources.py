@@ -0,0 +1,80 @@
+import threading
+
+import pygame
+from pygame.surface import Surface
+
+
+class ResourceManager:
+    def __init__(self):
+        self.raw_images: dict[str, Surface] = {}
+        # Keyed by path, color key and whether the image was converted to the display format
+        self.images: dict[tuple[str, tuple, bool], Surface] = {}
+        self.fonts: dict[tuple[str, int], pygame.font.Font] = {}
+        self.lock = threading.Lock()
+        self.loader: threading.Thread = None
+
+    def preload(self, images: list[tuple[str, tuple]] = (), fonts: list[tuple[str, int]] = (), progress=None):
+        # Loads on a background thread, progress is called with (loaded, total, path) after each asset
+        total = len(images) + len(fonts)
+
+        def load_all():
+            loaded = 0
+            for path, colorkey in images:
+                self.image(path, colorkey)
+                loaded += 1
+                if progress is not None:
+                    progress(loaded, total, path)
+            for path, size in fonts:
+                self.font(path, size)
+                loaded += 1
+                if progress is not None:
+                    progress(loaded, total, path)
+
+        self.loader = threading.Thread(target=load_all, daemon=True)
+        self.loader.start()
+        return self.loader
+
+    def wait(self):
+        if self.loader is not None:
+            self.loader.join()
+            self.loader = None
+
+    def image(self, path: str, colorkey: tuple = None) -> Surface:
+        # Images are converted once a display exists, until then the loaded image is returned
+        converted = pygame.display.get_init() and pygame.display.get_surface() is not None
+        key = (path, colorkey, converted)
+        image = self.images.get(key)
+        if image is not None:
+            return image
+
+        with self.lock:
+            if key in self.images:
+                return self.images[key]
+            if path not in self.raw_images:
+                self.raw_images[path] = pygame.image.load(path)
+            image = self.raw_images[path]
+            if converted:
+                image = image.convert()
+            elif colorkey is not None:
+                image = image.copy()
+            if colorkey is not None:
+                image.set_colorkey(colorkey)
+            self.images[key] = image
+            return image
+
+    def font(self, path: str, size: int) -> pygame.font.Font:
+        key = (path, size)
+        font = self.fonts.get(key)
+        if font is not None:
+            return font
+
+        with self.lock:
+            if key not in self.fonts:
+                if not pygame.font.get_init():
+                    pygame.font.init()
+                self.fonts[key] = pygame.font.Font(path, size)
+            return self.fonts[key]
+
+
+# Shared by every game of the repository
+resources = ResourceManager()